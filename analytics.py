@@ -0,0 +1,45 @@
+import threading
+from typing import Tuple
+
+import pandas as pd
+
+from database import db_aggregate, db_change_version, db_read_cursor
+
+_aggregates = {}  # (база данных, таблица, измерения) -> (версия, сводка)
+_aggregates_lock = threading.Lock()
+
+
+def get_aggregates(
+    db_name: str, tbl_name: str, by: Tuple[str, ...]
+) -> pd.DataFrame:
+    """
+    Возвращает число маркеров и сумму значений показателя в разрезе
+    измерений by. Сводка читается из поддерживаемой триггерами сводной
+    таблицы и кэшируется до следующей версии журнала изменений
+    """
+    key = (db_name, tbl_name, tuple(by))
+    with db_read_cursor(db_name) as cur:
+        version = db_change_version(cur, tbl_name)
+    cached = _aggregates.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with db_read_cursor(db_name) as cur:
+        cur.execute("BEGIN;")
+        version = db_change_version(cur, tbl_name)
+        rows = db_aggregate(cur, tbl_name, by)
+    aggregates = pd.DataFrame(
+        rows, columns=[*by, "num_markers", "total_value"]
+    )
+    with _aggregates_lock:
+        _aggregates[key] = (version, aggregates)
+    return aggregates
+
+
+def invalidate_aggregates(db_name: str):
+    """
+    Сбрасывает кэшированные сводки базы данных db_name
+    """
+    with _aggregates_lock:
+        for key in [key for key in _aggregates if key[0] == db_name]:
+            del _aggregates[key]
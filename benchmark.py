@@ -0,0 +1,380 @@
+"""
+Нагрузочные замеры горячих путей приложения без запуска Streamlit.
+
+Для каждого размера синтетического набора маркеров создается отдельная
+база данных, в которой замеряются импорт файла, чтение таблицы, снимок
+маркеров, добавление и удаление маркеров, построение слоев карты и
+сериализация карты в HTML. Для каждого замера записываются время,
+пиковый объем памяти (tracemalloc) и размер HTML-представления карты.
+
+Отдельно замеряется холодный старт: импорт модулей приложения и первая
+отрисовка пустой карты в новом процессе интерпретатора. Результат
+сравнивается с целевым значением COLD_START_TARGET_SECONDS, а также
+записывается, какие тяжелые пакеты были загружены при старте.
+
+Пример запуска:
+    python benchmark.py --sizes 1000 10000 --output bench.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List
+
+import folium
+import numpy as np
+import pandas as pd
+import pathlib2
+
+from database import (
+    db_create_table,
+    db_delete_records,
+    db_insert_record,
+    db_insert_record_many,
+    db_read_cursor,
+    db_read_table,
+    db_write_cursor,
+    get_connection_manager,
+)
+from importer import import_markers
+from map_layers import category_layers
+from markers import (
+    colors_for_marker,
+    get_marker_snapshot,
+    invalidate_marker_snapshot,
+    record_labels,
+)
+
+BENCHMARK_SIZES = (1000, 10000, 100000, 1000000)
+BENCHMARK_TBL_NAME = "markers"
+NUM_SINGLE_OPS = 100  # число одиночных добавлений и удалений маркеров
+# замеры, выполняющие NUM_SINGLE_OPS операций с маркерами
+_multi_op_cases = (
+    "insert_record",
+    "delete_record",
+    "insert_batch",
+    "delete_batch",
+)
+
+COLD_START_TARGET_SECONDS = 3.0  # целевое время холодного старта, [с]
+# модули, которые импортирует сценарий приложения (кроме Streamlit)
+APP_MODULES = (
+    "analytics",
+    "database",
+    "export",
+    "importer",
+    "instrumentation",
+    "logistics",
+    "map_cache",
+    "map_layers",
+    "markers",
+    "reports",
+)
+# тяжелые пакеты, которые должны загружаться при первом обращении
+LAZY_MODULES = ("scipy", "openpyxl", "pyarrow", "plotly")
+
+# сценарий холодного старта: выполняется в новом процессе интерпретатора
+_cold_start_script = """
+import json, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+imported = time.perf_counter()
+import folium
+folium.Map(location=[55.68, 37.8], zoom_start=8).get_root().render()
+print(json.dumps(dict(
+    import_seconds=imported - start,
+    first_paint_seconds=time.perf_counter() - start,
+    lazy_loaded=[name for name in {lazy!r} if name in sys.modules],
+)))
+"""
+
+# категории маркеров синтетического набора
+_categories = (
+    "Отходы трансгазы",
+    "Отходы добыча",
+    "Лом",
+    "Труба б/у",
+    "Труба категории А3",
+    "Площадки по отходам",
+)
+
+
+def synthetic_markers(num_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Генерирует num_rows маркеров с уникальными именами в окрестности
+    Москвы. Кадр данных имеет колонки record_labels
+    """
+    rng = np.random.RandomState(seed)
+    colors = list(colors_for_marker)
+    return pd.DataFrame(
+        dict(
+            zip(
+                record_labels,
+                (
+                    rng.uniform(54.0, 57.0, num_rows),
+                    rng.uniform(35.0, 40.0, num_rows),
+                    [f"MARKER_{num}" for num in range(num_rows)],
+                    rng.choice(_categories, num_rows),
+                    rng.uniform(0.0, 10000.0, num_rows).round(1),
+                    rng.choice(colors, num_rows),
+                ),
+            )
+        )
+    )
+
+
+def measure(
+    case: str,
+    num_rows: int,
+    func: Callable,
+    trace_memory: bool = True,
+    **extra,
+) -> dict:
+    """
+    Выполняет func и возвращает замер: время, [с] и пиковый объем
+    памяти, выделенной интерпретатором, [МБ]. Если func возвращает
+    словарь, он добавляется к замеру.
+
+    Учет памяти через tracemalloc замедляет выполнение, поэтому при
+    trace_memory=False замеряется только время
+    """
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func()
+        elapsed = time.perf_counter() - start
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    sample = dict(
+        case=case,
+        rows=num_rows,
+        seconds=round(elapsed, 6),
+        peak_mb=round(peak / 1024**2, 3) if peak is not None else None,
+        **extra,
+    )
+    if isinstance(result, dict):
+        sample.update(result)
+    line = f"{case:<16} {num_rows:>9} {sample['seconds']:>10.3f} с"
+    if peak is not None:
+        line += f" {sample['peak_mb']:>9.1f} МБ"
+    print(line)
+    return sample
+
+
+def benchmark_size(
+    num_rows: int, work_dir: pathlib2.Path, trace_memory: bool = True
+) -> List[dict]:
+    """
+    Замеряет горячие пути приложения на наборе из num_rows маркеров
+    """
+    db_name = str(work_dir / f"bench_{num_rows}.sqlite")
+    file_name = work_dir / f"markers_{num_rows}.csv"
+    synthetic_markers(num_rows).to_csv(file_name, index=False)
+    with db_write_cursor(db_name) as cur:
+        db_create_table(cur, BENCHMARK_TBL_NAME)
+
+    samples = []
+
+    def import_file():
+        # create_markers_from_excel
+        with db_write_cursor(db_name) as cur:
+            report = import_markers(cur, BENCHMARK_TBL_NAME, str(file_name))
+        return dict(inserted=report.inserted)
+
+    def read_table():
+        with db_read_cursor(db_name) as cur:
+            db_read_table(cur, BENCHMARK_TBL_NAME)
+
+    def build_snapshot():
+        invalidate_marker_snapshot(db_name)
+        get_marker_snapshot(db_name, BENCHMARK_TBL_NAME)
+
+    def insert_records():
+        # create_record_in_database: одна транзакция на маркер
+        for num in range(NUM_SINGLE_OPS):
+            with db_write_cursor(db_name) as cur:
+                db_insert_record(
+                    cur,
+                    BENCHMARK_TBL_NAME,
+                    (55.0, 37.0, f"BENCH_{num}", "Лом", 1.0, "красный"),
+                )
+
+    def delete_records():
+        # delete_records_from_database с одним именем: транзакция на маркер
+        for num in range(NUM_SINGLE_OPS):
+            with db_write_cursor(db_name) as cur:
+                db_delete_records(
+                    cur, BENCHMARK_TBL_NAME, marker_names=[f"BENCH_{num}"]
+                )
+
+    def insert_batch():
+        # маркеры для замера пакетного удаления
+        with db_write_cursor(db_name) as cur:
+            db_insert_record_many(
+                cur,
+                BENCHMARK_TBL_NAME,
+                [
+                    (55.0, 37.0, f"BENCH_{num}", "Лом", 1.0, "красный")
+                    for num in range(NUM_SINGLE_OPS)
+                ],
+            )
+
+    def delete_batch():
+        # delete_records_from_database: одна транзакция на все маркеры
+        with db_write_cursor(db_name) as cur:
+            num_deleted = db_delete_records(
+                cur,
+                BENCHMARK_TBL_NAME,
+                marker_names=[f"BENCH_{num}" for num in range(NUM_SINGLE_OPS)],
+            )
+        return dict(deleted=num_deleted)
+
+    main_map = None
+
+    def build_layers():
+        # put_markers_on_map: по слою на каждую категорию
+        nonlocal main_map
+        snapshot = get_marker_snapshot(db_name, BENCHMARK_TBL_NAME)
+        main_map = folium.Map(location=[55.68, 37.8], zoom_start=8)
+        for layer in category_layers(snapshot, snapshot.categories):
+            layer.add_to(main_map)
+        folium.LayerControl().add_to(main_map)
+
+    def render_html():
+        # render_map_html
+        html = main_map.get_root().render()
+        return dict(html_bytes=len(html.encode("utf-8")))
+
+    for case, func in (
+        ("import_file", import_file),
+        ("read_table", read_table),
+        ("build_snapshot", build_snapshot),
+        ("insert_record", insert_records),
+        ("delete_record", delete_records),
+        ("insert_batch", insert_batch),
+        ("delete_batch", delete_batch),
+        ("build_layers", build_layers),
+        ("render_html", render_html),
+    ):
+        ops = NUM_SINGLE_OPS if case in _multi_op_cases else 1
+        samples.append(measure(case, num_rows, func, trace_memory, ops=ops))
+
+    get_connection_manager(db_name).close()
+    return samples
+
+
+def cold_start(trace_memory: bool = False) -> dict:
+    """
+    Замеряет холодный старт приложения в новом процессе интерпретатора:
+    полное время (с запуском интерпретатора), время импорта модулей
+    приложения и время до первой отрисовки пустой карты
+    """
+
+    def run():
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                _cold_start_script.format(
+                    modules=APP_MODULES, lazy=LAZY_MODULES
+                ),
+            ],
+            cwd=str(pathlib2.Path(__file__).resolve().parent),
+        )
+        result = json.loads(output.decode("utf-8").splitlines()[-1])
+        for key in ("import_seconds", "first_paint_seconds"):
+            result[key] = round(result[key], 6)
+        return result
+
+    sample = measure(
+        "cold_start",
+        0,
+        run,
+        trace_memory,
+        target_seconds=COLD_START_TARGET_SECONDS,
+    )
+    sample["within_target"] = sample["seconds"] <= COLD_START_TARGET_SECONDS
+    if sample["lazy_loaded"]:
+        print(
+            "При старте загружены пакеты: " + ", ".join(sample["lazy_loaded"])
+        )
+    return sample
+
+
+def _git_revision() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("ascii")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmarks(sizes=BENCHMARK_SIZES, trace_memory: bool = True) -> dict:
+    """
+    Выполняет замеры для каждого размера набора маркеров из sizes.
+    Возвращает результаты с описанием окружения
+    """
+    samples = [cold_start()]
+    with tempfile.TemporaryDirectory(prefix="interactivemap_bench_") as tmp:
+        for num_rows in sizes:
+            samples += benchmark_size(
+                num_rows, pathlib2.Path(tmp), trace_memory
+            )
+    return dict(
+        revision=_git_revision(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        trace_memory=trace_memory,
+        samples=samples,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Нагрузочные замеры горячих путей приложения"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=list(BENCHMARK_SIZES),
+        help="размеры синтетических наборов маркеров",
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark_results.json",
+        help="файл для сохранения результатов в формате JSON",
+    )
+    parser.add_argument(
+        "--no-trace-memory",
+        action="store_true",
+        help="не учитывать память (точнее замеры времени)",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, not args.no_trace_memory)
+    pathlib2.Path(args.output).write_text(
+        json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8"
+    )
+    print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
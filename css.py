@@ -1,3 +1,4 @@
+import base64
 from typing import NoReturn
 
 import streamlit as st
@@ -67,3 +68,15 @@ def annotation_normal_css(
         f"color: {clr}'>{text}",
         unsafe_allow_html=True,
     )
+
+
+def download_link_css_sidebar(
+    data: bytes, file_name: str, text: str = "", clr: str = "black"
+) -> NoReturn:
+    b64_data = base64.b64encode(data).decode("ascii")
+    st.sidebar.markdown(
+        f"<a href='data:application/octet-stream;base64,{b64_data}' "
+        f"download='{file_name}' style='font-family: Helvetica, sans-serif;"
+        f"color: {clr}'>{text}</a>",
+        unsafe_allow_html=True,
+    )
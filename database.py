@@ -1,5 +1,13 @@
+import contextlib
+import math
+import os
+import queue
 import sqlite3
-from typing import List, Tuple
+import threading
+from collections import namedtuple
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from instrumentation import traced
 
 
 class RowsAlreadyExists(Exception):
@@ -9,13 +17,6 @@ class RowsAlreadyExists(Exception):
     """
 
 
-class MarkerNameError(Exception):
-    """
-    Пользовательское исключение. Возбуждается при попытке удалить запись по
-    отсутствующему в базе данных имени маркера
-    """
-
-
 class EmptyDatabase(Exception):
     """
     Пользовательское исключение. Возбуждается если при старте сессии
@@ -33,7 +34,238 @@ def db_conn_cursor(db_name: str):
     return conn, cur
 
 
+class ConnectionManager:
+    """
+    Процессный менеджер соединений с файловой базой данных SQLite.
+
+    Держит пул соединений только для чтения и одно соединение для записи,
+    доступ к которому сериализуется блокировкой. Соединения переживают
+    перезапуски скрипта Streamlit и разделяются между сессиями; база
+    переводится в режим журналирования WAL, поэтому читатели не блокируют
+    писателя и наоборот
+    """
+
+    def __init__(
+        self,
+        db_name: str,
+        pool_size: int = 4,
+        busy_timeout: int = 5000,
+    ):
+        self.db_name = db_name
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout  # [мс]
+        self._read_pool = queue.LifoQueue()  # пары (поколение, соединение)
+        self._num_read_conns = 0
+        # увеличивается при закрытии соединений: соединение прежнего
+        # поколения, выданное до закрытия, не возвращается в пул
+        self._generation = 0
+        self._pool_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._write_conn = None
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=self.busy_timeout / 1000,
+            # соединение используется одним потоком за раз
+            check_same_thread=False,
+        )
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout};")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA cache_size = -16000;")  # 16 МБ
+        conn.execute("PRAGMA mmap_size = 67108864;")  # 64 МБ
+        if read_only:
+            conn.execute("PRAGMA query_only = ON;")
+        else:
+            conn.execute("PRAGMA journal_mode = WAL;")
+        return conn
+
+    def _acquire_read_conn(self) -> Tuple[int, sqlite3.Connection]:
+        try:
+            return self._read_pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._pool_lock:
+            can_connect = self._num_read_conns < self.pool_size
+            if can_connect:
+                self._num_read_conns += 1
+            generation = self._generation
+        if can_connect:
+            try:
+                return generation, self._connect(read_only=True)
+            except sqlite3.Error:
+                with self._pool_lock:
+                    self._num_read_conns -= 1
+                raise
+        try:
+            return self._read_pool.get(timeout=self.busy_timeout / 1000)
+        except queue.Empty:
+            # вызывающий код обрабатывает ошибки базы данных, а не очереди
+            raise sqlite3.OperationalError("read pool exhausted") from None
+
+    @contextlib.contextmanager
+    def read_cursor(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Выдает курсор соединения из пула чтения и возвращает соединение
+        в пул по выходе из блока with
+        """
+        generation, conn = self._acquire_read_conn()
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            if conn.in_transaction:  # явно открытая транзакция чтения
+                conn.rollback()
+            with self._pool_lock:
+                stale = generation != self._generation
+                if stale:
+                    self._num_read_conns -= 1
+                else:
+                    self._read_pool.put((generation, conn))
+            if stale:  # соединение с файлом базы данных до закрытия
+                conn.close()
+
+    @contextlib.contextmanager
+    def write_cursor(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Выдает курсор соединения для записи. Транзакция фиксируется при
+        успешном выходе из блока with и откатывается при исключении
+        """
+        with self._write_lock:
+            if self._write_conn is None:
+                self._write_conn = self._connect(read_only=False)
+            conn = self._write_conn
+            cur = conn.cursor()
+            try:
+                yield cur
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                cur.close()
+
+    def close(self):
+        """
+        Закрывает все соединения менеджера. Новые соединения будут
+        открыты при следующем обращении; соединения, выданные в этот
+        момент, закрываются при возврате в пул
+        """
+        with self._write_lock:
+            if self._write_conn is not None:
+                self._write_conn.close()
+                self._write_conn = None
+        with self._pool_lock:
+            self._generation += 1
+            while True:
+                try:
+                    _, conn = self._read_pool.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+                self._num_read_conns -= 1
+
+
+_managers = {}  # путь к базе данных -> менеджер соединений
+_managers_lock = threading.Lock()
+
+
+def get_connection_manager(db_name: str) -> ConnectionManager:
+    """
+    Возвращает общий для процесса менеджер соединений с базой данных
+    """
+    with _managers_lock:
+        if db_name not in _managers:
+            _managers[db_name] = ConnectionManager(db_name)
+        return _managers[db_name]
+
+
+def db_read_cursor(db_name: str):
+    """
+    Контекстный менеджер курсора только для чтения из пула соединений
+    """
+    return get_connection_manager(db_name).read_cursor()
+
+
+def db_write_cursor(db_name: str):
+    """
+    Контекстный менеджер курсора для записи. Фиксирует транзакцию при
+    успешном выходе из блока with
+    """
+    return get_connection_manager(db_name).write_cursor()
+
+
+# (путь к базе данных, таблица) -> состояние файла базы данных, для
+# которого схема создана (см. _db_file_state)
+_ensured_tables = {}
+_ensured_lock = threading.Lock()
+
+
+def _db_file_state(db_name: str) -> Optional[Tuple[int, int, int]]:
+    """
+    Состояние файла базы данных: устройство и индексный дескриптор файла
+    и номер версии схемы. None, если файла нет
+    """
+    try:
+        stat = os.stat(db_name)
+    except OSError:
+        return None
+    with db_read_cursor(db_name) as cur:
+        cur.execute("PRAGMA schema_version;")
+        return stat.st_dev, stat.st_ino, cur.fetchone()[0]
+
+
+def db_ensure_table(db_name: str, tbl_name: str) -> bool:
+    """
+    Создает таблицу маркеров и служебные таблицы, если файл базы данных
+    новый или его схема изменилась с предыдущего вызова: при
+    перезапусках сценария проверяются только индексный дескриптор файла
+    и PRAGMA schema_version. Если файл заменен (например, восстановлен из
+    копии) или удален, соединения с прежним файлом закрываются.
+
+    Возвращает True, если файл базы данных заменен или удален: кэши,
+    построенные по версиям журнала изменений прежнего файла, должны быть
+    сброшены вызывающим кодом, так как версии нового файла начинаются
+    заново
+    """
+    key = (db_name, tbl_name)
+    state = _db_file_state(db_name)
+    ensured = _ensured_tables.get(key)
+    if state is not None and state == ensured:
+        return False
+    with _ensured_lock:
+        replaced = ensured is not None and (
+            state is None or state[:2] != ensured[:2]
+        )
+        if replaced:
+            get_connection_manager(db_name).close()
+        with db_write_cursor(db_name) as cur:
+            db_create_table(cur, tbl_name)
+        _ensured_tables[key] = _db_file_state(db_name)
+    return replaced
+
+
+# бизнес-колонки маркера, по которым определяется уникальность записи
+MARKER_COLUMNS = (
+    "longitude",
+    "latitude",
+    "marker_name",
+    "descr_pattern",
+    "marker_value",
+    "marker_clr",
+)
+
+
+@traced()
 def db_create_table(cur, tbl_name: str):
+    """
+    Создает таблицу маркеров и ее индексы. Для уже существующей таблицы
+    выполняет миграцию схемы (см. db_migrate_table)
+    """
     cur.execute(
         f"""
         CREATE TABLE IF NOT EXISTS {tbl_name}(
@@ -47,53 +279,1292 @@ def db_create_table(cur, tbl_name: str):
         );
         """
     )
+    db_migrate_table(cur, tbl_name)
+    db_create_browse_indexes(cur, tbl_name)
+    db_create_spatial_index(cur, tbl_name)
+    db_create_search_index(cur, tbl_name)
+    db_create_stats_table(cur, tbl_name)
+    db_create_change_log(cur, tbl_name)
+    db_create_attribute_tables(cur, tbl_name)
+
+
+def _db_object_exists(cur, obj_type: str, obj_name: str) -> bool:
+    cur.execute(
+        """
+        SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?;
+        """,
+        (obj_type, obj_name),
+    )
+    return cur.fetchone() is not None
+
+
+def db_migrate_table(cur, tbl_name: str):
+    """
+    Приводит схему таблицы к актуальной: удаляет дубликаты записей
+    (оставляя запись с наименьшим id) и создает уникальный индекс по
+    бизнес-колонкам и индекс по имени маркера.
+
+    Миграция выполняется только если уникального индекса еще нет, поэтому
+    повторный вызов не сканирует таблицу
+    """
+    if _db_object_exists(cur, "index", f"{tbl_name}_unique_record"):
+        return
+
+    columns = ", ".join(MARKER_COLUMNS)
+    cur.execute(
+        f"""
+        DELETE FROM {tbl_name} WHERE id NOT IN (
+          SELECT MIN(id) FROM {tbl_name} GROUP BY {columns}
+        );
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {tbl_name}_unique_record
+        ON {tbl_name}({columns});
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {tbl_name}_marker_name
+        ON {tbl_name}(marker_name);
+        """
+    )
+
+
+# колонки, по которым таблица маркеров сортируется и листается
+# постранично; для каждой колонки, кроме id, есть индекс (колонка, id)
+PAGE_SORT_COLUMNS = (
+    "id",
+    "marker_name",
+    "descr_pattern",
+    "marker_value",
+    "marker_clr",
+)
+
+
+def db_create_browse_indexes(cur, tbl_name: str):
+    """
+    Создает индексы для постраничного просмотра таблицы маркеров: по
+    категории, цвету и значению показателя (индекс по имени маркера
+    создается при миграции). Индекс SQLite хранит rowid, поэтому каждый
+    из них упорядочивает записи по (колонка, id)
+    """
+    for column in ("descr_pattern", "marker_clr", "marker_value"):
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {tbl_name}_{column}
+            ON {tbl_name}({column});
+            """
+        )
+
+
+def db_create_spatial_index(cur, tbl_name: str):
+    """
+    Создает пространственный индекс маркеров: виртуальную таблицу R*Tree,
+    которую триггеры синхронизируют с таблицей маркеров. Для существующей
+    таблицы индекс заполняется при создании.
+
+    Если SQLite собран без модуля R*Tree, создается составной индекс по
+    координатам
+    """
+    rtree_name = f"{tbl_name}_rtree"
+    if _db_object_exists(cur, "table", rtree_name):
+        return
+
+    try:
+        cur.execute(
+            f"""
+            CREATE VIRTUAL TABLE {rtree_name} USING rtree(
+              id, min_longitude, max_longitude, min_latitude, max_latitude
+            );
+            """
+        )
+    except sqlite3.OperationalError:  # no such module: rtree
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {tbl_name}_coordinates
+            ON {tbl_name}(longitude, latitude);
+            """
+        )
+        return
+
+    cur.execute(
+        f"""
+        INSERT INTO {rtree_name}
+        SELECT id, longitude, longitude, latitude, latitude FROM {tbl_name};
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {rtree_name}_insert
+        AFTER INSERT ON {tbl_name}
+        BEGIN
+          INSERT INTO {rtree_name}
+          VALUES (new.id, new.longitude, new.longitude,
+                  new.latitude, new.latitude);
+        END;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {rtree_name}_update
+        AFTER UPDATE OF longitude, latitude ON {tbl_name}
+        BEGIN
+          UPDATE {rtree_name}
+          SET min_longitude = new.longitude, max_longitude = new.longitude,
+              min_latitude = new.latitude, max_latitude = new.latitude
+          WHERE id = new.id;
+        END;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {rtree_name}_delete
+        AFTER DELETE ON {tbl_name}
+        BEGIN
+          DELETE FROM {rtree_name} WHERE id = old.id;
+        END;
+        """
+    )
+
+
+def db_create_search_index(cur, tbl_name: str):
+    """
+    Создает полнотекстовый индекс FTS5 по имени и категории маркера,
+    который триггеры синхронизируют с таблицей маркеров. Для существующей
+    таблицы индекс заполняется при создании.
+
+    Если SQLite собран без модуля FTS5, поиск выполняется по индексу
+    имени маркера
+    """
+    fts_name = f"{tbl_name}_fts"
+    if _db_object_exists(cur, "table", fts_name):
+        return
+
+    try:
+        cur.execute(
+            f"""
+            CREATE VIRTUAL TABLE {fts_name} USING fts5(
+              marker_name, descr_pattern,
+              content='{tbl_name}', content_rowid='id', prefix='2 3'
+            );
+            """
+        )
+    except sqlite3.OperationalError:  # no such module: fts5
+        return
+
+    cur.execute(f"INSERT INTO {fts_name}({fts_name}) VALUES ('rebuild');")
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {fts_name}_insert
+        AFTER INSERT ON {tbl_name}
+        BEGIN
+          INSERT INTO {fts_name}(rowid, marker_name, descr_pattern)
+          VALUES (new.id, new.marker_name, new.descr_pattern);
+        END;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {fts_name}_update
+        AFTER UPDATE OF marker_name, descr_pattern ON {tbl_name}
+        BEGIN
+          INSERT INTO {fts_name}({fts_name}, rowid, marker_name, descr_pattern)
+          VALUES ('delete', old.id, old.marker_name, old.descr_pattern);
+          INSERT INTO {fts_name}(rowid, marker_name, descr_pattern)
+          VALUES (new.id, new.marker_name, new.descr_pattern);
+        END;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {fts_name}_delete
+        AFTER DELETE ON {tbl_name}
+        BEGIN
+          INSERT INTO {fts_name}({fts_name}, rowid, marker_name, descr_pattern)
+          VALUES ('delete', old.id, old.marker_name, old.descr_pattern);
+        END;
+        """
+    )
+
+
+# центры филиалов, к ближайшему из которых относится маркер в сводках;
+# координаты в порядке колонок (longitude, latitude) таблицы маркеров
+REGION_CENTERS = {
+    "Югорск": (61.3124, 63.3310),
+    "Надым": (65.5377, 72.5181),
+    "Ухта": (63.5671, 53.6835),
+    "Тюмень": (57.1530, 65.5343),
+    "Томск": (56.4846, 84.9476),
+    "Уфа": (54.7348, 55.9579),
+    "Тимашевск": (45.6170, 38.9395),
+    "Москва": (55.7558, 37.6173),
+}
+# измерения сводной таблицы маркеров
+STATS_DIMENSIONS = ("region", "descr_pattern", "marker_clr")
+
+
+def _region_sql(tbl_name: str, row: str) -> str:
+    """
+    SQL-выражение ближайшего к записи row филиала. Расстояние оценивается
+    в градусах, вторая координата масштабируется на cos(60°)
+    """
+
+    def distance(region: str) -> str:
+        return (
+            f"({region}.longitude - {row}.longitude)"
+            f" * ({region}.longitude - {row}.longitude)"
+            f" + 0.25 * ({region}.latitude - {row}.latitude)"
+            f" * ({region}.latitude - {row}.latitude)"
+        )
+
+    if row in ("new", "old"):  # запись триггера
+        return f"""(
+          SELECT g.name FROM {tbl_name}_regions AS g
+          ORDER BY {distance("g")}
+          LIMIT 1
+        )"""
+    # SQLite не разрешает ссылки на запись внешнего запроса в ORDER BY
+    # подзапроса
+    return f"""(
+          SELECT g.name FROM {tbl_name}_regions AS g
+          WHERE {distance("g")} = (
+            SELECT MIN({distance("h")}) FROM {tbl_name}_regions AS h
+          )
+          LIMIT 1
+        )"""
+
+
+def db_create_stats_table(cur, tbl_name: str):
+    """
+    Создает сводную таблицу маркеров: число маркеров и сумму значений
+    показателя по филиалу, категории и цвету. Сводная таблица
+    поддерживается триггерами при вставке, изменении и удалении записей,
+    поэтому сводки не требуют пересчета по всей таблице маркеров.
+
+    Филиал маркера -- ближайший из REGION_CENTERS. Если список филиалов
+    изменился, таблица филиалов базы данных обновляется, а сводная
+    таблица пересчитывается
+    """
+    stats_name = f"{tbl_name}_stats"
+    regions_changed = _db_sync_regions(cur, tbl_name)
+    if _db_object_exists(cur, "table", stats_name) and not regions_changed:
+        return
+
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {stats_name}(
+          `region` TEXT NOT NULL,
+          `descr_pattern` TEXT NOT NULL,
+          `marker_clr` TEXT NOT NULL,
+          `num_markers` INTEGER NOT NULL,
+          `total_value` REAL NOT NULL,
+          PRIMARY KEY (region, descr_pattern, marker_clr)
+        ) WITHOUT ROWID;
+        """
+    )
+    cur.execute(f"DELETE FROM {stats_name};")
+    cur.execute(
+        f"""
+        INSERT INTO {stats_name}
+        SELECT region, descr_pattern, marker_clr, COUNT(*), SUM(marker_value)
+        FROM (
+          SELECT {_region_sql(tbl_name, "m")} AS region,
+                 descr_pattern, marker_clr, marker_value
+          FROM {tbl_name} AS m
+        )
+        GROUP BY region, descr_pattern, marker_clr;
+        """
+    )
+
+    if sqlite3.sqlite_version_info >= (3, 24, 0):
+        # филиал записи вычисляется один раз: счетчики ячейки сводной
+        # таблицы изменяются одним UPSERT
+        add_new = f"""
+          INSERT INTO {stats_name}
+          VALUES ({_region_sql(tbl_name, "new")}, new.descr_pattern,
+                  new.marker_clr, 1, new.marker_value)
+          ON CONFLICT (region, descr_pattern, marker_clr) DO UPDATE
+          SET num_markers = num_markers + 1,
+              total_value = total_value + excluded.total_value;
+        """
+        remove_old = f"""
+          INSERT INTO {stats_name}
+          VALUES ({_region_sql(tbl_name, "old")}, old.descr_pattern,
+                  old.marker_clr, -1, -old.marker_value)
+          ON CONFLICT (region, descr_pattern, marker_clr) DO UPDATE
+          SET num_markers = num_markers - 1,
+              total_value = total_value + excluded.total_value;
+          DELETE FROM {stats_name} WHERE num_markers <= 0;
+        """
+    else:  # SQLite до 3.24 не поддерживает UPSERT
+        add_new = f"""
+          INSERT OR IGNORE INTO {stats_name}
+          VALUES ({_region_sql(tbl_name, "new")}, new.descr_pattern,
+                  new.marker_clr, 0, 0);
+          UPDATE {stats_name}
+          SET num_markers = num_markers + 1,
+              total_value = total_value + new.marker_value
+          WHERE region = {_region_sql(tbl_name, "new")}
+            AND descr_pattern = new.descr_pattern
+            AND marker_clr = new.marker_clr;
+        """
+        remove_old = f"""
+          UPDATE {stats_name}
+          SET num_markers = num_markers - 1,
+              total_value = total_value - old.marker_value
+          WHERE region = {_region_sql(tbl_name, "old")}
+            AND descr_pattern = old.descr_pattern
+            AND marker_clr = old.marker_clr;
+          DELETE FROM {stats_name} WHERE num_markers <= 0;
+        """
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {stats_name}_insert
+        AFTER INSERT ON {tbl_name}
+        BEGIN {add_new} END;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {stats_name}_update
+        AFTER UPDATE ON {tbl_name}
+        BEGIN {remove_old} {add_new} END;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {stats_name}_delete
+        AFTER DELETE ON {tbl_name}
+        BEGIN {remove_old} END;
+        """
+    )
+
+
+def _db_sync_regions(cur, tbl_name: str) -> bool:
+    """
+    Приводит таблицу филиалов базы данных к REGION_CENTERS. Возвращает
+    True, если таблица филиалов изменена
+    """
+    regions_name = f"{tbl_name}_regions"
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {regions_name}(
+          `name` TEXT PRIMARY KEY NOT NULL,
+          `longitude` REAL NOT NULL,
+          `latitude` REAL NOT NULL
+        );
+        """
+    )
+    cur.execute(f"SELECT name, longitude, latitude FROM {regions_name};")
+    if {name: (lon, lat) for name, lon, lat in cur.fetchall()} == {
+        name: tuple(center) for name, center in REGION_CENTERS.items()
+    }:
+        return False
+
+    cur.execute(f"DELETE FROM {regions_name};")
+    cur.executemany(
+        f"""
+        INSERT INTO {regions_name}(name, longitude, latitude)
+        VALUES (?, ?, ?);
+        """,
+        [(name, *center) for name, center in REGION_CENTERS.items()],
+    )
+    return True
 
 
-def db_insert_record(cur, tbl_name: str, record: Tuple):
+CHANGE_LOG_SIZE = 100000  # сколько последних изменений хранит журнал
+
+# операции журнала изменений маркеров
+CHANGE_INSERT = "I"
+CHANGE_UPDATE = "U"
+CHANGE_DELETE = "D"
+CHANGE_RESET = "R"  # таблица маркеров пересоздана, id могут повторяться
+
+
+def db_create_change_log(cur, tbl_name: str):
     """
-    Вставляет одну запись в таблицу базы данных
+    Создает журнал изменений маркеров: каждая вставка, изменение и
+    удаление записи получает монотонно возрастающий номер версии.
+    Журнал хранит последние CHANGE_LOG_SIZE изменений и переживает
+    пересоздание таблицы маркеров (см. db_reset_table)
     """
+    changes_name = f"{tbl_name}_changes"
     cur.execute(
         f"""
-        INSERT INTO {tbl_name}(longitude, latitude, marker_name, descr_pattern, marker_value, marker_clr)
+        CREATE TABLE IF NOT EXISTS {changes_name}(
+          `version` INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+          `marker_id` INTEGER,
+          `operation` TEXT NOT NULL
+        );
+        """
+    )
+    for event, operation, row in (
+        ("INSERT", CHANGE_INSERT, "new"),
+        ("UPDATE", CHANGE_UPDATE, "new"),
+        ("DELETE", CHANGE_DELETE, "old"),
+    ):
+        cur.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {changes_name}_{event.lower()}
+            AFTER {event} ON {tbl_name}
+            BEGIN
+              INSERT INTO {changes_name}(marker_id, operation)
+              VALUES ({row}.id, '{operation}');
+              DELETE FROM {changes_name}
+              WHERE version <= last_insert_rowid() - {CHANGE_LOG_SIZE};
+            END;
+            """
+        )
+
+
+@traced(query=True)
+def db_change_version(cur, tbl_name: str) -> int:
+    """
+    Возвращает номер последнего изменения таблицы маркеров
+    """
+    cur.execute(f"SELECT MAX(version) FROM {tbl_name}_changes;")
+    version = cur.fetchone()[0]
+    return version if version is not None else 0
+
+
+@traced(query=True)
+def db_changes_since(
+    cur, tbl_name: str, version: int
+) -> Optional[List[Tuple[int, int, str]]]:
+    """
+    Возвращает изменения таблицы маркеров после версии version в виде
+    списка (версия, id маркера, операция).
+
+    Возвращает None, если изменения нельзя применить как приращение:
+    часть журнала уже удалена или таблица маркеров была пересоздана
+    """
+    cur.execute(f"SELECT MIN(version), MAX(version) FROM {tbl_name}_changes;")
+    min_version, max_version = cur.fetchone()
+    if max_version is None or version >= max_version:
+        return [] if version == (max_version or 0) else None
+    if min_version > version + 1:
+        return None
+
+    cur.execute(
+        f"""
+        SELECT version, marker_id, operation FROM {tbl_name}_changes
+        WHERE version > ? ORDER BY version;
+        """,
+        (version,),
+    )
+    changes = cur.fetchall()
+    if any(operation == CHANGE_RESET for _, _, operation in changes):
+        return None
+    return changes
+
+
+@traced(query=True)
+def db_select_ids(cur, tbl_name: str, ids: Iterable[int]) -> List[Tuple]:
+    """
+    Читает записи маркеров с заданными id
+    """
+    ids = list(ids)
+    records = []
+    # ограничение SQLite на число параметров запроса
+    for start in range(0, len(ids), 500):
+        chunk = ids[start : start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        cur.execute(
+            f"SELECT * FROM {tbl_name} WHERE id IN ({placeholders});",
+            chunk,
+        )
+        records += cur.fetchall()
+    return records
+
+
+# типы дополнительных полей маркеров
+FIELD_REAL = "REAL"
+FIELD_TEXT = "TEXT"
+FIELD_TYPES = (FIELD_REAL, FIELD_TEXT)
+
+
+def db_create_attribute_tables(cur, tbl_name: str):
+    """
+    Создает хранилище дополнительных полей маркеров: таблицу значений
+    атрибутов (маркер, имя поля, значение) и таблицу наборов полей по
+    категориям. Новое поле добавляется строкой в таблицу наборов полей,
+    без перестройки таблицы маркеров. Числовые и текстовые значения
+    хранятся в отдельных колонках и индексируются по имени поля и
+    значению, поэтому фильтры по атрибутам не сканируют таблицу
+    """
+    attributes_name = f"{tbl_name}_attributes"
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {tbl_name}_category_fields(
+          `descr_pattern` TEXT NOT NULL,
+          `name` TEXT NOT NULL,
+          `field_type` TEXT NOT NULL,
+          `label` TEXT NOT NULL,
+          PRIMARY KEY (descr_pattern, name)
+        ) WITHOUT ROWID;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {attributes_name}(
+          `marker_id` INTEGER NOT NULL,
+          `name` TEXT NOT NULL,
+          `value_num` REAL,
+          `value_text` TEXT,
+          PRIMARY KEY (marker_id, name)
+        ) WITHOUT ROWID;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {attributes_name}_num
+        ON {attributes_name}(name, value_num)
+        WHERE value_num IS NOT NULL;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {attributes_name}_text
+        ON {attributes_name}(name, value_text)
+        WHERE value_text IS NOT NULL;
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {attributes_name}_delete
+        AFTER DELETE ON {tbl_name}
+        BEGIN
+          DELETE FROM {attributes_name} WHERE marker_id = old.id;
+        END;
+        """
+    )
+
+
+@traced(query=True)
+def db_add_category_field(
+    cur,
+    tbl_name: str,
+    descr_pattern: str,
+    name: str,
+    field_type: str,
+    label: str,
+):
+    """
+    Добавляет поле name типа field_type (см. FIELD_TYPES) в набор полей
+    категории descr_pattern или обновляет описание существующего поля
+    """
+    if field_type not in FIELD_TYPES:
+        raise ValueError(f"Неизвестный тип поля: {field_type}")
+
+    cur.execute(
+        f"""
+        INSERT OR REPLACE INTO {tbl_name}_category_fields
+        VALUES (?, ?, ?, ?);
+        """,
+        (descr_pattern, name, field_type, label),
+    )
+
+
+@traced(query=True)
+def db_category_fields(
+    cur, tbl_name: str, descr_pattern: Optional[str] = None
+) -> List[Tuple[str, str, str, str]]:
+    """
+    Возвращает поля категории descr_pattern или, если категория не
+    задана, поля всех категорий в виде (категория, имя, тип, подпись)
+    """
+    condition, params = "", ()
+    if descr_pattern is not None:
+        condition, params = "WHERE descr_pattern = ?", (descr_pattern,)
+    cur.execute(
+        f"""
+        SELECT descr_pattern, name, field_type, label
+        FROM {tbl_name}_category_fields {condition}
+        ORDER BY descr_pattern, name;
+        """,
+        params,
+    )
+    return cur.fetchall()
+
+
+@traced(query=True)
+def db_set_attributes(cur, tbl_name: str, marker_id: int, attributes: dict):
+    """
+    Записывает значения дополнительных полей маркера marker_id. Числа
+    сохраняются в числовую колонку, остальные значения -- в текстовую;
+    значение None удаляет поле маркера
+    """
+    for name, value in attributes.items():
+        if value is None:
+            cur.execute(
+                f"""
+                DELETE FROM {tbl_name}_attributes
+                WHERE marker_id = ? AND name = ?;
+                """,
+                (marker_id, name),
+            )
+            continue
+
+        is_number = isinstance(value, (int, float)) and not isinstance(
+            value, bool
+        )
+        cur.execute(
+            f"""
+            INSERT OR REPLACE INTO {tbl_name}_attributes
+            VALUES (?, ?, ?, ?);
+            """,
+            (
+                marker_id,
+                name,
+                float(value) if is_number else None,
+                None if is_number else str(value),
+            ),
+        )
+
+
+@traced(query=True)
+def db_get_attributes(cur, tbl_name: str, marker_id: int) -> dict:
+    """
+    Возвращает значения дополнительных полей маркера marker_id
+    """
+    cur.execute(
+        f"""
+        SELECT name, COALESCE(value_num, value_text)
+        FROM {tbl_name}_attributes WHERE marker_id = ?;
+        """,
+        (marker_id,),
+    )
+    return dict(cur.fetchall())
+
+
+@traced(query=True)
+def db_filter_by_attribute(
+    cur,
+    tbl_name: str,
+    name: str,
+    min_value: Optional[float] = None,
+    max_value: Optional[float] = None,
+    equals: Optional[str] = None,
+) -> List[Tuple]:
+    """
+    Возвращает маркеры, у которых поле name лежит в диапазоне
+    [min_value, max_value] или (для текстовых полей) равно equals,
+    вместе со значением поля. Отбор выполняется по индексу атрибутов
+    """
+    if equals is not None:
+        condition, params = "a.value_text = ?", [equals]
+    else:
+        condition, params = "a.value_num IS NOT NULL", []
+        if min_value is not None:
+            condition += " AND a.value_num >= ?"
+            params.append(min_value)
+        if max_value is not None:
+            condition += " AND a.value_num <= ?"
+            params.append(max_value)
+    cur.execute(
+        f"""
+        SELECT m.*, COALESCE(a.value_num, a.value_text)
+        FROM {tbl_name}_attributes AS a
+        JOIN {tbl_name} AS m ON m.id = a.marker_id
+        WHERE a.name = ? AND {condition}
+        ORDER BY m.id;
+        """,
+        [name, *params],
+    )
+    return cur.fetchall()
+
+
+@traced()
+def db_reset_table(cur, tbl_name: str):
+    """
+    Очищает базу данных маркеров одной транзакцией: удаляет таблицу
+    маркеров вместе с ее индексами, триггерами и производными таблицами и
+    создает их заново. Параллельные сессии видят либо прежнюю, либо новую
+    пустую таблицу
+    """
+    if not cur.connection.in_transaction:
+        # DDL в модуле sqlite3 не открывает транзакцию неявно
+        cur.execute("BEGIN;")
+    for derived_name in (
+        f"{tbl_name}_rtree",
+        f"{tbl_name}_fts",
+        f"{tbl_name}_stats",
+        f"{tbl_name}_attributes",
+    ):
+        cur.execute(f"DROP TABLE IF EXISTS {derived_name};")
+    cur.execute(f"DROP TABLE IF EXISTS {tbl_name};")
+    db_create_table(cur, tbl_name)
+    cur.execute(
+        f"""
+        INSERT INTO {tbl_name}_changes(marker_id, operation)
+        VALUES (NULL, '{CHANGE_RESET}');
+        """
+    )
+
+
+@traced(query=True, rowcount=True)
+def db_insert_record(cur, tbl_name: str, record: Tuple) -> int:
+    """
+    Вставляет одну запись в таблицу базы данных. Дубликаты отсекаются
+    уникальным индексом.
+
+    Возвращает число вставленных записей: 1 или 0, если такая запись
+    уже существует. id вставленной записи доступен как cur.lastrowid
+    """
+    cur.execute(
+        f"""
+        INSERT OR IGNORE INTO {tbl_name}(longitude, latitude, marker_name, descr_pattern, marker_value, marker_clr)
         VALUES (?, ?, ?, ?, ?, ?);
         """,
         record,
     )
+    return cur.rowcount
 
 
-def db_insert_record_many(cur, tbl_name: str, records: List[Tuple]):
+@traced(query=True, rowcount=True)
+def db_insert_record_many(cur, tbl_name: str, records: Iterable[Tuple]) -> int:
     """
-    Вставляет несколько записей в таблицу базы данных
+    Вставляет несколько записей в таблицу базы данных одним executemany.
+    Дубликаты отсекаются уникальным индексом.
+
+    Возвращает число вставленных записей
     """
     cur.executemany(
         f"""
-        INSERT INTO {tbl_name}(longitude, latitude, marker_name, descr_pattern, marker_value, marker_clr)
-        VALUES (?, ?, ?, ?, ?);
+        INSERT OR IGNORE INTO {tbl_name}(longitude, latitude, marker_name, descr_pattern, marker_value, marker_clr)
+        VALUES (?, ?, ?, ?, ?, ?);
         """,
         records,
     )
+    return cur.rowcount
 
 
-def db_delete_record(cur, tbl_name: str, marker_name: str):
+@traced(query=True, rowcount=True)
+def db_delete_records(
+    cur,
+    tbl_name: str,
+    marker_names: Optional[Iterable[str]] = None,
+    ids: Optional[Iterable[int]] = None,
+    categories: Optional[Iterable[str]] = None,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+) -> int:
     """
-    Удаляет одну запись из таблицы базы данных
+    Удаляет записи маркеров по спискам имен и/или id, по категориям и по
+    прямоугольнику координат bbox=(min_longitude, max_longitude,
+    min_latitude, max_latitude). Удаляются маркеры из объединения списков
+    имен и id, удовлетворяющие всем заданным условиям категорий и bbox;
+    без списков -- все маркеры, удовлетворяющие условиям.
+
+    Условие выполняется одним запросом DELETE по индексам (списки
+    длиннее 500 элементов -- по запросу на каждые 500) в транзакции
+    курсора. Журнал изменений, сводная таблица и поисковые индексы
+    обновляются триггерами. Возвращает число удаленных записей
+    """
+    if marker_names is None and ids is None and not categories and not bbox:
+        raise ValueError("Не задано ни одного условия удаления маркеров")
+
+    conditions, params = [], []
+    if categories:
+        categories = list(categories)
+        conditions.append(
+            f"descr_pattern IN ({', '.join('?' * len(categories))})"
+        )
+        params += categories
+    if bbox:
+        rtree_name = f"{tbl_name}_rtree"
+        if _db_object_exists(cur, "table", rtree_name):
+            # кандидаты отбираются по пространственному индексу, точная
+            # проверка -- по координатам маркера (см. db_select_bbox)
+            conditions.append(
+                f"""id IN (
+                  SELECT id FROM {rtree_name}
+                  WHERE max_longitude >= ? AND min_longitude <= ?
+                    AND max_latitude >= ? AND min_latitude <= ?
+                )"""
+            )
+            params += list(bbox)
+        conditions.append(
+            "longitude BETWEEN ? AND ? AND latitude BETWEEN ? AND ?"
+        )
+        params += list(bbox)
+
+    keys = [
+        (column, list(values))
+        for column, values in (("marker_name", marker_names), ("id", ids))
+        if values is not None
+    ]
+    if not keys:
+        cur.execute(
+            f"DELETE FROM {tbl_name} WHERE {' AND '.join(conditions)};",
+            params,
+        )
+        return cur.rowcount
+
+    num_deleted = 0
+    # ограничение SQLite на число параметров запроса
+    for column, values in keys:
+        for start in range(0, len(values), 500):
+            chunk = values[start : start + 500]
+            where = " AND ".join(
+                [f"{column} IN ({', '.join('?' * len(chunk))})", *conditions]
+            )
+            cur.execute(
+                f"DELETE FROM {tbl_name} WHERE {where};", chunk + params
+            )
+            num_deleted += cur.rowcount
+    return num_deleted
+
+
+@traced(query=True)
+def db_read_table(cur, tbl_name: str) -> List[Tuple[int, float, float, str]]:
+    """
+    Читает таблицу базы данных в список кортежей
     """
     cur.execute(
         f"""
-        DELETE FROM {tbl_name} WHERE marker_name = ?
+        SELECT * FROM {tbl_name};
+        """
+    )
+    return cur.fetchall()
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(
+    longitude1: float, latitude1: float, longitude2: float, latitude2: float
+) -> float:
+    """
+    Расстояние по большому кругу между двумя маркерами, [км].
+
+    Пара (longitude, latitude) передается в folium в качестве location,
+    поэтому колонка longitude интерпретируется как географическая широта,
+    а колонка latitude -- как географическая долгота
+    """
+    phi1, phi2 = math.radians(longitude1), math.radians(longitude2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(latitude2 - latitude1)
+    a = (
+        math.sin(d_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+@traced(query=True)
+def db_select_bbox(
+    cur,
+    tbl_name: str,
+    min_longitude: float,
+    max_longitude: float,
+    min_latitude: float,
+    max_latitude: float,
+) -> List[Tuple]:
+    """
+    Читает записи маркеров, попадающие в прямоугольник координат, через
+    пространственный индекс
+    """
+    params = (min_longitude, max_longitude, min_latitude, max_latitude)
+    rtree_name = f"{tbl_name}_rtree"
+    if _db_object_exists(cur, "table", rtree_name):
+        # R*Tree хранит границы с одинарной точностью, округляя их наружу,
+        # поэтому точная проверка выполняется по таблице маркеров
+        cur.execute(
+            f"""
+            SELECT m.* FROM {rtree_name} AS r
+            JOIN {tbl_name} AS m ON m.id = r.id
+            WHERE r.max_longitude >= ? AND r.min_longitude <= ?
+              AND r.max_latitude >= ? AND r.min_latitude <= ?
+              AND m.longitude BETWEEN ? AND ?
+              AND m.latitude BETWEEN ? AND ?;
+            """,
+            params + params,
+        )
+    else:
+        cur.execute(
+            f"""
+            SELECT * FROM {tbl_name}
+            WHERE longitude BETWEEN ? AND ? AND latitude BETWEEN ? AND ?;
+            """,
+            params,
+        )
+    return cur.fetchall()
+
+
+def _radius_boxes(
+    longitude: float, latitude: float, radius_km: float
+) -> List[Tuple[float, float, float, float]]:
+    """
+    Прямоугольники координат (min_longitude, max_longitude, min_latitude,
+    max_latitude), покрывающие сферическую шапку радиуса radius_km с
+    центром в точке. Колонка longitude хранит широту φ, latitude --
+    долготу λ.
+
+    Полуширина шапки по долготе -- asin(sin(r/R) / cos φ); если шапка
+    содержит полюс, прямоугольник охватывает все долготы. Прямоугольник,
+    пересекающий антимеридиан, делится на два
+    """
+    angle = radius_km / EARTH_RADIUS_KM  # угловой радиус шапки, [рад]
+    d_longitude = math.degrees(angle)
+    min_longitude = max(longitude - d_longitude, -90.0)
+    max_longitude = min(longitude + d_longitude, 90.0)
+    if (
+        angle >= math.pi / 2
+        or longitude + d_longitude >= 90.0
+        or longitude - d_longitude <= -90.0
+    ):
+        return [(min_longitude, max_longitude, -180.0, 180.0)]
+
+    d_latitude = math.degrees(
+        math.asin(
+            min(math.sin(angle) / math.cos(math.radians(longitude)), 1.0)
+        )
+    )
+    min_latitude, max_latitude = latitude - d_latitude, latitude + d_latitude
+    if min_latitude < -180.0:
+        return [
+            (min_longitude, max_longitude, min_latitude + 360.0, 180.0),
+            (min_longitude, max_longitude, -180.0, max_latitude),
+        ]
+    if max_latitude > 180.0:
+        return [
+            (min_longitude, max_longitude, min_latitude, 180.0),
+            (min_longitude, max_longitude, -180.0, max_latitude - 360.0),
+        ]
+    return [(min_longitude, max_longitude, min_latitude, max_latitude)]
+
+
+@traced()
+def db_select_radius(
+    cur,
+    tbl_name: str,
+    longitude: float,
+    latitude: float,
+    radius_km: float,
+) -> List[Tuple[Tuple, float]]:
+    """
+    Читает записи маркеров в пределах radius_km километров от точки.
+    Кандидаты отбираются по описанному прямоугольнику через
+    пространственный индекс, затем проверяется точное расстояние.
+
+    Возвращает пары (запись, расстояние в км), упорядоченные по
+    расстоянию
+    """
+    candidates = {}
+    for box in _radius_boxes(longitude, latitude, radius_km):
+        for record in db_select_bbox(cur, tbl_name, *box):
+            candidates[record[0]] = record
+    found = []
+    for record in candidates.values():
+        distance = haversine_km(longitude, latitude, record[1], record[2])
+        if distance <= radius_km:
+            found.append((record, distance))
+    found.sort(key=lambda item: item[1])
+    return found
+
+
+@traced()
+def db_select_nearest(
+    cur,
+    tbl_name: str,
+    longitude: float,
+    latitude: float,
+    k: int,
+    start_radius_km: float = 10.0,
+) -> List[Tuple[Tuple, float]]:
+    """
+    Читает k ближайших к точке записей маркеров, удваивая радиус поиска,
+    пока в нем не окажется k записей.
+
+    Возвращает пары (запись, расстояние в км), упорядоченные по
+    расстоянию
+    """
+    cur.execute(f"SELECT COUNT(*) FROM {tbl_name};")
+    k = min(k, cur.fetchone()[0])
+    if k <= 0:
+        return []
+
+    radius_km = start_radius_km
+    while True:
+        found = db_select_radius(cur, tbl_name, longitude, latitude, radius_km)
+        # половина длины экватора покрывает весь земной шар
+        if len(found) >= k or radius_km >= math.pi * EARTH_RADIUS_KM:
+            return found[:k]
+        radius_km *= 2
+
+
+@traced(query=True)
+def db_search_markers(
+    cur, tbl_name: str, query: str, limit: int = 20
+) -> List[Tuple]:
+    """
+    Ищет маркеры, имя или категория которых содержат слова, начинающиеся
+    с введенных в query. Результаты упорядочены по релевантности
+    """
+    words = query.split()
+    if not words:
+        return []
+
+    fts_name = f"{tbl_name}_fts"
+    if _db_object_exists(cur, "table", fts_name):
+        fts_query = " AND ".join(
+            '"{}"*'.format(word.replace('"', '""')) for word in words
+        )
+        cur.execute(
+            f"""
+            SELECT m.* FROM {fts_name} AS f
+            JOIN {tbl_name} AS m ON m.id = f.rowid
+            WHERE {fts_name} MATCH ?
+            ORDER BY f.rank
+            LIMIT ?;
+            """,
+            (fts_query, limit),
+        )
+    else:
+        # поиск по префиксу имени маркера через индекс имени
+        prefix = query.strip().upper()
+        cur.execute(
+            f"""
+            SELECT * FROM {tbl_name}
+            WHERE marker_name >= ? AND marker_name < ?
+            ORDER BY marker_name
+            LIMIT ?;
+            """,
+            (prefix, prefix + "\U0010ffff", limit),
+        )
+    return cur.fetchall()
+
+
+# отбор маркеров для постраничного просмотра: категории, цвета, диапазон
+# значений показателя и префикс имени; None -- без ограничения
+MarkerFilter = namedtuple(
+    "MarkerFilter",
+    ["categories", "colors", "min_value", "max_value", "name_prefix"],
+    defaults=(None, None, None, None, None),
+)
+
+
+def _marker_filter_sql(marker_filter: MarkerFilter) -> Tuple[str, list]:
+    conditions, params = [], []
+    for column, values in (
+        ("descr_pattern", marker_filter.categories),
+        ("marker_clr", marker_filter.colors),
+    ):
+        if values:
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params += list(values)
+    if marker_filter.min_value is not None:
+        conditions.append("marker_value >= ?")
+        params.append(marker_filter.min_value)
+    if marker_filter.max_value is not None:
+        conditions.append("marker_value <= ?")
+        params.append(marker_filter.max_value)
+    if marker_filter.name_prefix:
+        # диапазон по индексу имени маркера
+        prefix = marker_filter.name_prefix
+        conditions.append("marker_name >= ? AND marker_name < ?")
+        params += [prefix, prefix + "\U0010ffff"]
+    return " AND ".join(conditions) or "1", params
+
+
+@traced(query=True)
+def db_select_page(
+    cur,
+    tbl_name: str,
+    marker_filter: MarkerFilter = MarkerFilter(),
+    sort_by: str = "id",
+    descending: bool = False,
+    limit: int = 100,
+    offset: int = 0,
+    after: Optional[Tuple] = None,
+) -> List[Tuple]:
+    """
+    Возвращает страницу из не более чем limit маркеров, отобранных по
+    marker_filter и упорядоченных по колонке sort_by (см.
+    PAGE_SORT_COLUMNS), а затем по id.
+
+    Если задан ключ after -- (значение sort_by, id) последней записи
+    предыдущей страницы, -- страница начинается сразу за ним (keyset),
+    иначе пропускается offset записей. Идентификаторы записей страницы
+    отбираются по индексу колонки sort_by, а сами записи читаются только
+    для них
+    """
+    if sort_by not in PAGE_SORT_COLUMNS:
+        raise ValueError(f"Неизвестная колонка сортировки: {sort_by}")
+
+    where, params = _marker_filter_sql(marker_filter)
+    direction = "DESC" if descending else "ASC"
+    if sort_by == "id":
+        order = f"id {direction}"
+    else:
+        order = f"{sort_by} {direction}, id {direction}"
+    if after is not None:
+        sign = "<" if descending else ">"
+        if sort_by == "id":
+            where += f" AND id {sign} ?"
+            params.append(after[-1])
+        else:
+            where += f" AND ({sort_by}, id) {sign} (?, ?)"
+            params += [after[0], after[-1]]
+        offset = 0
+
+    cur.execute(
+        f"""
+        SELECT m.* FROM (
+          SELECT id FROM {tbl_name}
+          WHERE {where}
+          ORDER BY {order}
+          LIMIT ? OFFSET ?
+        ) AS p
+        JOIN {tbl_name} AS m ON m.id = p.id
+        ORDER BY {", ".join("m." + term for term in order.split(", "))};
         """,
-        (marker_name,),
+        [*params, limit, offset],
     )
+    return cur.fetchall()
 
 
-def db_read_table(cur, tbl_name: str) -> List[Tuple[int, float, float, str]]:
+@traced(query=True)
+def db_count_markers(
+    cur, tbl_name: str, marker_filter: MarkerFilter = MarkerFilter()
+) -> int:
     """
-    Читает таблицу базы данных в список кортежей
+    Возвращает число маркеров, отобранных по marker_filter. Отбор только
+    по категориям и цветам считается по сводной таблице без обращения к
+    таблице маркеров
+    """
+    where, params = _marker_filter_sql(marker_filter)
+    if (
+        marker_filter.min_value is None
+        and marker_filter.max_value is None
+        and not marker_filter.name_prefix
+    ):
+        cur.execute(
+            f"SELECT SUM(num_markers) FROM {tbl_name}_stats WHERE {where};",
+            params,
+        )
+    else:
+        cur.execute(f"SELECT COUNT(*) FROM {tbl_name} WHERE {where};", params)
+    return cur.fetchone()[0] or 0
+
+
+@traced(query=True)
+def db_aggregate(cur, tbl_name: str, by: Tuple[str, ...]) -> List[Tuple]:
+    """
+    Читает из сводной таблицы число маркеров и сумму значений показателя
+    в разрезе измерений by (см. STATS_DIMENSIONS).
+
+    Возвращает кортежи (значения измерений..., число маркеров, сумма)
     """
+    unknown = set(by) - set(STATS_DIMENSIONS)
+    if unknown:
+        raise ValueError(f"Неизвестные измерения сводки: {unknown}")
+
+    columns = ", ".join(by)
     cur.execute(
         f"""
-        SELECT * FROM {tbl_name};
+        SELECT {columns}, SUM(num_markers), SUM(total_value)
+        FROM {tbl_name}_stats
+        GROUP BY {columns}
+        ORDER BY {columns};
         """
     )
     return cur.fetchall()
+
+
+def db_backup(
+    cur,
+    target_name: str,
+    pages: int = 1024,
+    progress: Optional[Callable[[int, int], None]] = None,
+):
+    """
+    Копирует базу данных соединения курсора в файл target_name через
+    онлайн-API резервного копирования SQLite. Копирование идет порциями
+    по pages страниц и не блокирует писателей дольше одной порции.
+
+    progress(скопировано страниц, всего страниц) вызывается после каждой
+    порции
+    """
+    target = sqlite3.connect(target_name)
+    try:
+
+        def report_progress(status, remaining, total):
+            if progress is not None:
+                progress(total - remaining, total)
+
+        cur.connection.backup(target, pages=pages, progress=report_progress)
+    finally:
+        target.close()
+
+
+def db_dump_sql(cur, tbl_name: str, file_obj, fetch_size: int = 5000):
+    """
+    Потоково записывает SQL-дамп таблицы маркеров и таблиц
+    дополнительных полей (наборов полей по категориям и значений
+    атрибутов) в текстовый файловый объект file_obj. Значения
+    экранируются функцией quote() SQLite.
+
+    В дамп попадают только схема и записи этих таблиц: индексы, триггеры
+    и производные таблицы (пространственный и поисковый индексы, сводная
+    таблица, журнал изменений) восстанавливаются db_create_table при
+    первом подключении приложения к восстановленной базе. Дамп iterdump
+    непригоден для этого, так как виртуальные таблицы FTS5 и R*Tree
+    выгружаются в нем через writable_schema и не восстанавливаются
+    одним скриптом
+    """
+    file_obj.write("BEGIN TRANSACTION;\n")
+    for name in (
+        tbl_name,
+        f"{tbl_name}_category_fields",
+        f"{tbl_name}_attributes",
+    ):
+        cur.execute(
+            """
+            SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?;
+            """,
+            (name,),
+        )
+        row = cur.fetchone()
+        if row is None:  # база данных до появления дополнительных полей
+            continue
+        file_obj.write(f"{row[0]};\n")
+
+        cur.execute(f"PRAGMA table_info({name});")
+        values = " || ',' || ".join(
+            f"quote({column[1]})" for column in cur.fetchall()
+        )
+        # WITHOUT ROWID-таблицы читаются в порядке первичного ключа
+        order = " ORDER BY id" if name == tbl_name else ""
+        cur.execute(
+            f"""
+            SELECT 'INSERT INTO {name} VALUES(' || {values} || ');'
+            FROM {name}{order};
+            """
+        )
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            file_obj.writelines(f"{statement}\n" for statement, in rows)
+    file_obj.write("COMMIT;\n")
+
+
+def db_iter_table(
+    cur, tbl_name: str, fetch_size: int = 5000
+) -> Iterator[List[Tuple]]:
+    """
+    Читает таблицу маркеров порциями по fetch_size записей
+    """
+    cur.execute(
+        f"""
+        SELECT * FROM {tbl_name} ORDER BY id;
+        """
+    )
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            break
+        yield rows
@@ -0,0 +1,132 @@
+import functools
+import importlib.util
+import time
+from typing import Callable, Optional
+
+import pathlib2
+
+from database import db_backup, db_dump_sql, db_iter_table, db_read_cursor
+
+EXPORTS_DIR = "./exports"  # каталог выгрузок по умолчанию
+EXPORT_FETCH_SIZE = 5000  # число записей, читаемых из базы за раз
+
+EXPORT_BACKUP = "Копия базы данных (.sqlite)"
+EXPORT_SQL = "SQL-дамп (.sql)"
+EXPORT_PARQUET = "Таблица маркеров (.parquet)"
+EXPORT_FEATHER = "Таблица маркеров (.feather)"
+EXPORT_FORMATS = (EXPORT_BACKUP, EXPORT_SQL) + (
+    # колоночные форматы требуют необязательного пакета pyarrow; сам пакет
+    # загружается при первой колоночной выгрузке
+    (EXPORT_PARQUET, EXPORT_FEATHER)
+    if importlib.util.find_spec("pyarrow") is not None
+    else ()
+)
+_export_suffixes = {
+    EXPORT_BACKUP: ".sqlite",
+    EXPORT_SQL: ".sql",
+    EXPORT_PARQUET: ".parquet",
+    EXPORT_FEATHER: ".feather",
+}
+
+
+def export_database(
+    db_name: str,
+    tbl_name: str,
+    export_format: str,
+    export_dir: str = EXPORTS_DIR,
+    progress: Optional[Callable[[float], None]] = None,
+) -> pathlib2.Path:
+    """
+    Выгружает базу данных маркеров в каталог export_dir в формате
+    export_format без загрузки таблицы в память целиком:
+    копией файла через онлайн-API резервного копирования, SQL-дампом
+    таблицы маркеров и дополнительных полей (см. db_dump_sql) или
+    колоночным файлом Parquet/Feather. Колоночные файлы содержат только
+    таблицу маркеров: дополнительные поля и их значения сохраняются
+    копией базы данных или SQL-дампом.
+
+    progress(доля выполненной работы) вызывается по ходу выгрузки.
+    Возвращает путь к файлу выгрузки
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Неподдерживаемый формат выгрузки: {export_format}")
+
+    export_path = pathlib2.Path(export_dir)
+    export_path.mkdir(parents=True, exist_ok=True)
+    file_name = export_path / (
+        f"{tbl_name}_{time.strftime('%Y%m%d_%H%M%S')}"
+        f"{_export_suffixes[export_format]}"
+    )
+    progress = progress if progress is not None else (lambda share: None)
+
+    with db_read_cursor(db_name) as cur:
+        if export_format == EXPORT_BACKUP:
+            db_backup(
+                cur,
+                str(file_name),
+                progress=lambda done, total: progress(done / max(total, 1)),
+            )
+        elif export_format == EXPORT_SQL:
+            with open(str(file_name), "w", encoding="utf-8") as file_obj:
+                db_dump_sql(cur, tbl_name, file_obj)
+        else:
+            _export_columnar(cur, tbl_name, file_name, export_format, progress)
+    progress(1.0)
+    return file_name
+
+
+@functools.lru_cache(maxsize=None)
+def _arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("id", pa.int64()),
+            ("longitude", pa.float64()),
+            ("latitude", pa.float64()),
+            ("marker_name", pa.string()),
+            ("descr_pattern", pa.string()),
+            ("marker_value", pa.float64()),
+            ("marker_clr", pa.string()),
+        ]
+    )
+
+
+def _export_columnar(
+    cur,
+    tbl_name: str,
+    file_name: pathlib2.Path,
+    export_format: str,
+    progress: Callable[[float], None],
+):
+    """
+    Пишет таблицу маркеров в Parquet или Feather (Arrow IPC) по одной
+    порции записей за раз
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema()
+    cur.execute(f"SELECT COUNT(*) FROM {tbl_name};")
+    num_records = cur.fetchone()[0]
+
+    if export_format == EXPORT_PARQUET:
+        writer = pq.ParquetWriter(str(file_name), schema)
+    else:
+        writer = pa.ipc.new_file(str(file_name), schema)
+    try:
+        num_written = 0
+        for rows in db_iter_table(cur, tbl_name, EXPORT_FETCH_SIZE):
+            columns = zip(*rows)
+            batch = pa.RecordBatch.from_arrays(
+                [
+                    pa.array(column, type=field.type)
+                    for column, field in zip(columns, schema)
+                ],
+                schema=schema,
+            )
+            writer.write_table(pa.Table.from_batches([batch]))
+            num_written += len(rows)
+            progress(num_written / max(num_records, 1))
+    finally:
+        writer.close()
@@ -0,0 +1,205 @@
+import time
+from collections import namedtuple
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from database import db_insert_record_many
+from instrumentation import traced
+from markers import Record_wo_id, colors_for_marker, round_marker_value
+
+IMPORT_CHUNK_SIZE = 5000  # число записей в одной транзакции
+FIRST_DATA_ROW = 2  # номер первой строки данных: первая -- заголовок
+MAX_REPORTED_REJECTS = 100  # сколько отклоненных строк попадает в отчет
+
+ImportReport = namedtuple(
+    "ImportReport",
+    ["total", "inserted", "skipped", "rejected", "elapsed", "rejects"],
+)
+
+# допустимые написания цвета маркера -> цвет, хранимый в базе данных
+_colors_aliases = {
+    **{clr: clr for clr in colors_for_marker},
+    **{eng_clr: clr for clr, eng_clr in colors_for_marker.items()},
+}
+
+
+def iter_markers_chunks(
+    file_name, chunk_size: int = IMPORT_CHUNK_SIZE
+) -> Iterator[Tuple[pd.DataFrame, Optional[int]]]:
+    """
+    Потоково читает Excel- или CSV-файл маркеров порциями по chunk_size
+    строк. Принимает путь к файлу или загруженный через Streamlit файл.
+
+    Возвращает итератор пар (кадр данных с колонками Record_wo_id,
+    оценка общего числа строк файла или None, если она неизвестна).
+    Индекс кадра -- номер строки в файле, считая с единицы и со строкой
+    заголовка, как в Excel
+    """
+    name = str(getattr(file_name, "name", file_name)).lower()
+    if name.endswith(".csv"):
+        for chunk in pd.read_csv(
+            file_name,
+            names=Record_wo_id._fields,
+            header=0,
+            chunksize=chunk_size,
+        ):
+            chunk.index += FIRST_DATA_ROW
+            yield chunk, None
+    elif name.endswith(".xlsx"):
+        yield from _iter_xlsx_chunks(file_name, chunk_size)
+    else:
+        # старый формат .xls не поддерживает потоковое чтение
+        df = pd.read_excel(file_name, names=Record_wo_id._fields)
+        df.index += FIRST_DATA_ROW
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start : start + chunk_size], len(df)
+
+
+def _iter_xlsx_chunks(
+    file_name, chunk_size: int
+) -> Iterator[Tuple[pd.DataFrame, Optional[int]]]:
+    """
+    Читает первый лист xlsx-файла в режиме read-only, не загружая
+    книгу в память целиком
+    """
+    import openpyxl  # загружается при первом импорте xlsx-файла
+
+    workbook = openpyxl.load_workbook(
+        file_name, read_only=True, data_only=True
+    )
+    try:
+        sheet = workbook.worksheets[0]
+        # max_row берется из метаданных листа и может отсутствовать
+        total = sheet.max_row - 1 if sheet.max_row else None
+        ncols = len(Record_wo_id._fields)
+        rows, row_numbers = [], []
+        # номера строк считаются по листу: пустые строки пропускаются, но
+        # не сдвигают номера следующих
+        for row_number, row in enumerate(
+            sheet.iter_rows(
+                min_row=FIRST_DATA_ROW, max_col=ncols, values_only=True
+            ),
+            start=FIRST_DATA_ROW,
+        ):
+            if all(value is None for value in row):
+                continue
+            rows.append(row)
+            row_numbers.append(row_number)
+            if len(rows) == chunk_size:
+                yield _frame_from_rows(rows, row_numbers), total
+                rows, row_numbers = [], []
+        if rows:
+            yield _frame_from_rows(rows, row_numbers), total
+    finally:
+        workbook.close()
+
+
+def _frame_from_rows(
+    rows: List[Tuple], row_numbers: List[int]
+) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=Record_wo_id._fields, index=row_numbers)
+
+
+def prepare_markers(df: pd.DataFrame) -> Tuple[pd.DataFrame, List[Tuple]]:
+    """
+    Векторно нормализует и проверяет кадр данных маркеров:
+    приводит координаты и значения к числам, имена маркеров к верхнему
+    регистру, округляет значение показателя и сопоставляет цвета.
+
+    Возвращает кадр корректных записей и список отклоненных строк
+    в виде кортежей (номер строки, причина)
+    """
+    longitude = pd.to_numeric(df["longitude"], errors="coerce")
+    latitude = pd.to_numeric(df["latitude"], errors="coerce")
+    marker_value = pd.to_numeric(df["marker_value"], errors="coerce")
+    marker_name = df["marker_name"].astype("string").str.strip().str.upper()
+    descr_pattern = df["descr_pattern"].astype("string").str.strip()
+    marker_clr = (
+        df["marker_clr"]
+        .astype("string")
+        .str.strip()
+        .str.lower()
+        .map(_colors_aliases)
+    )
+
+    checks = (
+        (longitude.isna(), "некорректная долгота"),
+        (latitude.isna(), "некорректная широта"),
+        ((longitude.abs() > 180) | (latitude.abs() > 180), "вне диапазона"),
+        (marker_name.isna() | (marker_name == ""), "пустое имя маркера"),
+        (descr_pattern.isna() | (descr_pattern == ""), "пустая категория"),
+        (marker_value.isna(), "некорректное значение показателя"),
+        (marker_clr.isna(), "неизвестный цвет маркера"),
+    )
+    rejected = np.zeros(len(df), dtype=bool)
+    rejects = []
+    for mask, reason in checks:
+        mask = mask.fillna(False).to_numpy(dtype=bool) & ~rejected
+        rejected |= mask
+        rejects.extend((int(idx), reason) for idx in df.index[mask])
+    rejects.sort()
+
+    valid = ~rejected
+    prepared = pd.DataFrame(
+        {
+            "longitude": longitude[valid].astype(float),
+            "latitude": latitude[valid].astype(float),
+            "marker_name": marker_name[valid].astype(object),
+            "descr_pattern": descr_pattern[valid].astype(object),
+            "marker_value": marker_value[valid].map(round_marker_value),
+            "marker_clr": marker_clr[valid].astype(object),
+        },
+        columns=Record_wo_id._fields,
+    )
+    return prepared, rejects
+
+
+@traced()
+def import_markers(
+    cur,
+    tbl_name: str,
+    file_name,
+    chunk_size: int = IMPORT_CHUNK_SIZE,
+    progress: Optional[Callable[[int, Optional[int]], None]] = None,
+) -> ImportReport:
+    """
+    Потоково импортирует маркеры из Excel- или CSV-файла в таблицу базы
+    данных: каждая порция из chunk_size строк проверяется и записывается
+    в своей транзакции сразу после чтения, поэтому в памяти находится не
+    больше одной порции.
+
+    После каждой порции вызывается progress(обработано строк, оценка
+    общего числа строк или None). Возвращает отчет об импорте
+    """
+    start = time.perf_counter()
+    conn = cur.connection
+    total = num_inserted = num_valid = num_rejected = 0
+    rejects = []
+    for chunk, total_estimate in iter_markers_chunks(file_name, chunk_size):
+        prepared, chunk_rejects = prepare_markers(chunk)
+        try:
+            num_inserted += db_insert_record_many(
+                cur, tbl_name, prepared.itertuples(index=False, name=None)
+            )
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
+        total += len(chunk)
+        num_valid += len(prepared)
+        num_rejected += len(chunk_rejects)
+        rejects.extend(chunk_rejects[: MAX_REPORTED_REJECTS - len(rejects)])
+        if progress is not None:
+            progress(total, total_estimate)
+
+    return ImportReport(
+        total=total,
+        inserted=num_inserted,
+        skipped=num_valid - num_inserted,
+        rejected=num_rejected,
+        elapsed=time.perf_counter() - start,
+        rejects=rejects,
+    )
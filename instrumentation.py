@@ -0,0 +1,216 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from typing import Callable, Iterable, List, Optional
+
+TRACE_ENV_VAR = "INTERACTIVEMAP_TRACE"  # "1" -- замеры во всех сессиях
+MAX_TRACES = 100  # сколько последних замеров хранится для выгрузки
+
+# замеры пишутся в журнал одной JSON-строкой на перезапуск; если
+# приложение не настроило обработчики журнала, записи выводятся в stderr
+logger = logging.getLogger("interactivemap.trace")
+
+# замер одного этапа: глубина вложенности, время, [с], число запросов к
+# базе данных и число строк, прочитанных или измененных ими (с учетом
+# вложенных этапов)
+Span = namedtuple("Span", ["name", "depth", "seconds", "queries", "rows"])
+
+
+class Trace:
+    """
+    Замеры этапов одного перезапуска сценария Streamlit
+    """
+
+    def __init__(self):
+        self.created = time.time()
+        self.spans = []
+        self.queries = 0
+        self.rows = 0
+        self.depth = 0
+
+    def records(self) -> List[dict]:
+        return [span._asdict() for span in self.spans if span is not None]
+
+
+class _TraceLocal(threading.local):
+    # значение по умолчанию на уровне класса: чтение атрибута в потоке без
+    # замеров не вызывает исключения
+    trace = None
+
+
+# замеры ведутся в потоке перезапуска сценария; если замер потока не
+# начат, обертки сводятся к одной проверке атрибута
+_local = _TraceLocal()
+_traces = deque(maxlen=MAX_TRACES)
+_traces_lock = threading.Lock()
+_null_span = contextlib.nullcontext()
+
+
+def start_rerun(enabled: bool = False) -> Optional[Trace]:
+    """
+    Начинает замеры перезапуска сценария в текущем потоке, если замеры
+    включены флагом enabled или переменной окружения TRACE_ENV_VAR
+    """
+    enabled = enabled or os.environ.get(TRACE_ENV_VAR) == "1"
+    if enabled:
+        _ensure_log_handler()
+    _local.trace = Trace() if enabled else None
+    return _local.trace
+
+
+def _ensure_log_handler():
+    if logger.handlers or logging.getLogger().handlers:
+        return
+    with _traces_lock:
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+
+
+def finish_rerun() -> Optional[Trace]:
+    """
+    Завершает замеры перезапуска: сохраняет их для выгрузки и пишет в
+    журнал одной JSON-строкой. Возвращает замеры или None
+    """
+    trace = _local.trace
+    _local.trace = None
+    if trace is not None:
+        with _traces_lock:
+            _traces.append(trace)
+        logger.info(trace_json(trace))
+    return trace
+
+
+def span(name: str):
+    """
+    Контекстный менеджер замера этапа name
+    """
+    trace = _local.trace
+    if trace is None:
+        return _null_span
+    return _span(trace, name)
+
+
+@contextlib.contextmanager
+def _span(trace: Trace, name: str):
+    # место этапа резервируется при входе, чтобы этапы шли в порядке начала
+    index = len(trace.spans)
+    trace.spans.append(None)
+    depth, queries, rows = trace.depth, trace.queries, trace.rows
+    trace.depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.depth = depth
+        trace.spans[index] = Span(
+            name,
+            depth,
+            time.perf_counter() - start,
+            trace.queries - queries,
+            trace.rows - rows,
+        )
+
+
+def _num_rows(result, rowcount: bool) -> int:
+    if rowcount:
+        return max(result, 0) if isinstance(result, int) else 0
+    return len(result) if isinstance(result, list) else 0
+
+
+def traced(
+    name: Optional[str] = None, query: bool = False, rowcount: bool = False
+) -> Callable:
+    """
+    Декоратор замера функции. При query=True вызов учитывается как
+    запрос к базе данных, а длина возвращенного списка записей -- как
+    число строк; при rowcount=True число строк -- возвращенное функцией
+    число измененных записей
+    """
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _local.trace
+            if trace is None:
+                return func(*args, **kwargs)
+
+            with _span(trace, span_name):
+                result = func(*args, **kwargs)
+                if query:
+                    trace.queries += 1
+                    trace.rows += _num_rows(result, rowcount)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def recent_traces() -> List[Trace]:
+    with _traces_lock:
+        return list(_traces)
+
+
+def trace_json(trace: Trace) -> str:
+    """
+    Структурированная запись замеров перезапуска в формате JSON
+    """
+    return json.dumps(
+        dict(
+            created=trace.created,
+            queries=trace.queries,
+            rows=trace.rows,
+            spans=trace.records(),
+        ),
+        ensure_ascii=False,
+    )
+
+
+def prometheus_text(traces: Iterable[Trace]) -> str:
+    """
+    Сводка замеров traces в текстовом формате Prometheus: суммарное время
+    и число вызовов этапов, число запросов и строк
+    """
+    seconds, counts = OrderedDict(), OrderedDict()
+    queries = rows = 0
+    for trace in traces:
+        queries += trace.queries
+        rows += trace.rows
+        for item in trace.spans:
+            if item is None:
+                continue
+            seconds[item.name] = seconds.get(item.name, 0.0) + item.seconds
+            counts[item.name] = counts.get(item.name, 0) + 1
+
+    lines = [
+        "# HELP interactivemap_span_seconds Время выполнения этапов",
+        "# TYPE interactivemap_span_seconds summary",
+    ]
+    for name, total in seconds.items():
+        lines.append(
+            f'interactivemap_span_seconds_sum{{span="{name}"}} {total:.6f}'
+        )
+        lines.append(
+            f'interactivemap_span_seconds_count{{span="{name}"}} '
+            f"{counts[name]}"
+        )
+    lines += [
+        "# HELP interactivemap_queries_total Число запросов к базе данных",
+        "# TYPE interactivemap_queries_total counter",
+        f"interactivemap_queries_total {queries}",
+        "# HELP interactivemap_rows_total Число строк в запросах",
+        "# TYPE interactivemap_rows_total counter",
+        f"interactivemap_rows_total {rows}",
+        "",
+    ]
+    return "\n".join(lines)
@@ -1,28 +1,93 @@
 import sqlite3
-import subprocess
-from collections import namedtuple
-from typing import NoReturn
+from typing import NoReturn, Optional, Tuple
 
 import folium
-import numpy as np
 import pandas as pd
 import pathlib2
 
 # import plotly.express as px
-import plotly.graph_objects as go
 import streamlit as st
-from streamlit_folium import folium_static
-
-from css import annotation_css, annotation_css_sidebar, header_css, logo_css
+import streamlit.components.v1 as components
+
+from analytics import get_aggregates, invalidate_aggregates
+from css import (
+    annotation_css,
+    annotation_css_sidebar,
+    download_link_css_sidebar,
+    header_css,
+    logo_css,
+)
 from database import (
+    FIELD_REAL,
+    FIELD_TYPES,
     EmptyDatabase,
-    MarkerNameError,
+    MarkerFilter,
     RowsAlreadyExists,
-    db_conn_cursor,
-    db_create_table,
-    db_delete_record,
+    db_add_category_field,
+    db_category_fields,
+    db_count_markers,
+    db_delete_records,
+    db_ensure_table,
+    db_filter_by_attribute,
     db_insert_record,
-    db_read_table,
+    db_read_cursor,
+    db_reset_table,
+    db_search_markers,
+    db_select_nearest,
+    db_select_page,
+    db_select_radius,
+    db_set_attributes,
+    db_write_cursor,
+    get_connection_manager,
+)
+from export import EXPORT_FORMATS, EXPORTS_DIR, export_database
+from importer import ImportReport, import_markers
+from instrumentation import (
+    Trace,
+    finish_rerun,
+    prometheus_text,
+    recent_traces,
+    span,
+    start_rerun,
+    trace_json,
+    traced,
+)
+from logistics import (
+    FACILITY_CATEGORIES,
+    SOLVER_TIME_BUDGET,
+    SOURCE_CATEGORIES,
+    assignment_labels,
+    flow_labels,
+    get_facility_assignment,
+    get_transport_plan,
+    invalidate_logistics,
+)
+from map_cache import map_cache_key, map_html_cache
+from map_layers import (
+    MAP_HEIGHT,
+    MAP_WIDTH,
+    RENDER_CLUSTERS,
+    RENDER_MODES,
+    MapSettings,
+    category_layers,
+    flow_layer,
+    viewport_bounds,
+)
+from markers import (
+    Record,
+    colors_for_marker,
+    get_marker_snapshot,
+    invalidate_marker_snapshot,
+    record_labels,
+    round_marker_value,
+)
+from reports import (
+    JOB_FAILED,
+    JOB_PENDING,
+    JOB_RUNNING,
+    REPORT_FORMATS,
+    get_report_job,
+    submit_report,
 )
 
 st.set_page_config(
@@ -35,53 +100,33 @@ st.set_page_config(
 
 DB_NAME_PATH = "./gisobjects.sqlite"  # файловая база данных
 MARKER_TBL_NAME = "markers"  # таблица маркеров
-Record = namedtuple(
-    "Record",
-    [
-        "id",
-        "longitude",
-        "latitude",
-        "marker_name",
-        "descr_pattern",
-        "marker_value",
-        "marker_clr",
-    ],
-)
-Record_wo_id = namedtuple(
-    "Record_wo_id",
-    [
-        "longitude",
-        "latitude",
-        "marker_name",
-        "descr_pattern",
-        "marker_value",
-        "marker_clr",
-    ],
-)
-colors_for_marker = {
-    "красный": "red",
-    "темно-красный": "darkred",
-    "зеленый": "green",
-    "темно-зеленый": "darkgreen",
-    "синий": "blue",
-    "темно-синий": "darkblue",
-    "оранжевый": "orange",
-    "фиолетовый": "purple",
-    "черный": "black",
+MAP_TILES = "OpenStreetMap"  # подложка карты
+# предельный размер файла, предлагаемого для скачивания, [байт]: файл
+# передается в браузер в base64 одним сообщением
+MAX_DOWNLOAD_SIZE = 5 * 1024**2
+MARKER_TABLE_PAGE_SIZES = (25, 50, 100, 500)  # записей на странице таблицы
+# подписи колонок сортировки таблицы маркеров
+sort_labels = {
+    "id": "Порядок добавления",
+    "marker_name": record_labels[2],
+    "descr_pattern": record_labels[3],
+    "marker_value": record_labels[4],
+    "marker_clr": record_labels[5],
 }
 
 
 def init_db():
     try:
-        conn, cur = db_conn_cursor(DB_NAME_PATH)
-        db_create_table(cur, MARKER_TBL_NAME)
+        if db_ensure_table(DB_NAME_PATH, MARKER_TBL_NAME):
+            # версии журнала изменений нового файла начинаются заново
+            invalidate_marker_snapshot(DB_NAME_PATH)
+            invalidate_aggregates(DB_NAME_PATH)
+            invalidate_logistics(DB_NAME_PATH)
     except sqlite3.DatabaseError as err:
         print(f"Ошбика база данных: {err}")
-    finally:
-        cur.close()
-        conn.close()
 
 
+@traced()
 def main_elements():
     """
     Создает шапку страницы
@@ -124,8 +169,9 @@ def main_elements():
 
     with row2_1:
         uploaded_file = st.file_uploader(
-            "Для добавления нескольких маркеров на карту выберите Excel-файл...",
-            type=["xls", "xlsx"],
+            "Для добавления нескольких маркеров на карту выберите Excel- "
+            "или CSV-файл...",
+            type=["xls", "xlsx", "csv"],
             accept_multiple_files=False,
         )
 
@@ -135,122 +181,194 @@ def main_elements():
     with row2_2:
         pass
 
-    try:
-        conn, cur = db_conn_cursor(DB_NAME_PATH)
-        list_records = db_read_table(cur, MARKER_TBL_NAME)
+    st.markdown("_База данных маркеров_")
+
+    marker_table_elements()  # отображает базу данных маркеров
+
+    # width, height = GetSystemMetrics(0), GetSystemMetrics(1)
+    # fraction_width = 0.735
+    # fraction_height = 0.55
+
+
+@traced()
+def marker_table_elements():
+    """
+    Создает постраничное представление базы данных маркеров с отбором и
+    сортировкой. Из базы читается и передается в браузер только
+    отображаемая страница
+    """
+    with st.beta_expander("Отбор и сортировка маркеров"):
+        row1_1, row1_2, row1_3 = st.beta_columns(3)
+        with row1_1:
+            categories = st.multiselect(
+                "Категории маркеров",
+                get_aggregates(
+                    DB_NAME_PATH, MARKER_TBL_NAME, ("descr_pattern",)
+                )["descr_pattern"].tolist(),
+                key="table_categories",
+            )
+            name_prefix = st.text_input(
+                "Имя маркера начинается с", key="table_name_prefix"
+            )
+        with row1_2:
+            colors = st.multiselect(
+                "Цвета маркеров",
+                get_aggregates(DB_NAME_PATH, MARKER_TBL_NAME, ("marker_clr",))[
+                    "marker_clr"
+                ].tolist(),
+                key="table_colors",
+            )
+            min_value = max_value = None
+            if st.checkbox("Ограничить значение показателя"):
+                min_value = st.number_input(
+                    "Не менее, [т]", value=0.0, key="table_min_value"
+                )
+                max_value = st.number_input(
+                    "Не более, [т]", value=1000.0, key="table_max_value"
+                )
+        with row1_3:
+            sort_by = st.selectbox(
+                "Сортировать по",
+                list(sort_labels),
+                format_func=lambda column: sort_labels[column],
+                key="table_sort_by",
+            )
+            descending = st.checkbox("По убыванию", key="table_descending")
+            page_size = st.selectbox(
+                "Записей на странице",
+                MARKER_TABLE_PAGE_SIZES,
+                index=1,
+                key="table_page_size",
+            )
 
-        # список записей таблицы без индекса
-        list_records_wo_id = [record[1:] for record in list_records]
+    marker_filter = MarkerFilter(
+        categories=categories,
+        colors=colors,
+        min_value=min_value,
+        max_value=max_value,
+        name_prefix=name_prefix.strip().upper(),
+    )
+    try:
+        with db_read_cursor(DB_NAME_PATH) as cur:
+            num_records = db_count_markers(cur, MARKER_TBL_NAME, marker_filter)
     except sqlite3.DatabaseError as err:
         print(f"Ошбика база данных: {err}")
-    finally:
-        cur.close()
-        conn.close()
-
-    st.markdown("_База данных маркеров_")
+        return
+
+    num_pages = max((num_records + page_size - 1) // page_size, 1)
+    # без ключа: при изменении числа страниц номер страницы сбрасывается
+    page = st.number_input(
+        f"Страница (из {num_pages})",
+        min_value=1,
+        max_value=num_pages,
+        value=1,
+    )
+    offset = (page - 1) * page_size
+    try:
+        with db_read_cursor(DB_NAME_PATH) as cur:
+            records = db_select_page(
+                cur,
+                MARKER_TBL_NAME,
+                marker_filter,
+                sort_by,
+                descending,
+                limit=page_size,
+                offset=offset,
+            )
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+        return
 
-    st.dataframe(  # отображает базу данных маркеров
+    st.dataframe(
         pd.DataFrame(
-            list_records_wo_id,
-            columns=[
-                "Долгота",
-                "Широта",
-                "Имя маркера",
-                "Категория",
-                "Значение показателя",
-                "Цвет маркера",
-            ],
+            [record[1:] for record in records],
+            columns=record_labels,
+            index=range(offset + 1, offset + len(records) + 1),
         )
     )
-
-    folium.LayerControl().add_to(main_map)
-
-    # width, height = GetSystemMetrics(0), GetSystemMetrics(1)
-    # fraction_width = 0.735
-    # fraction_height = 0.55
+    if records:
+        st.markdown(
+            f"_Записи {offset + 1}–{offset + len(records)} "
+            f"из {num_records}_"
+        )
 
 
+@traced()
 def create_markers_from_excel(excel_file_name):
-    excel_file = pd.read_excel(
-        excel_file_name,
-        names=[
-            "longitude",
-            "latitude",
-            "marker_name",
-            "descr",
-            "marker_value",
-            "marker_clr",
-        ],
-    )
-    list_tuples_from_excel = [
-        tuple(record)[1:] for record in list(excel_file.to_records())
-    ]
-    list_tuples_from_excel = [
-        (
-            Record_wo_id(*record).longitude,
-            Record_wo_id(*record).latitude,
-            Record_wo_id(*record).marker_name.upper(),
-            Record_wo_id(*record).descr_pattern,
-            float(f"{Record_wo_id(*record).marker_value:.1f}"),
-            Record_wo_id(*record).marker_clr,
-        )
-        for record in list_tuples_from_excel
-    ]
+    """
+    Потоково импортирует маркеры из Excel- или CSV-файла, отображая ход
+    импорта, и выводит отчет об импорте
+    """
+    progress_bar = st.progress(0)
+    progress_text = st.empty()
 
-    try:
-        conn, cur = db_conn_cursor(DB_NAME_PATH)
-        list_records = db_read_table(cur, MARKER_TBL_NAME)
-        list_records = [record[1:] for record in list_records]
+    def show_progress(num_rows: int, total_rows: Optional[int]) -> NoReturn:
+        if total_rows:
+            progress_bar.progress(min(num_rows / total_rows, 1.0))
+        progress_text.text(f"Обработано строк: {num_rows}")
 
-        for record in list_tuples_from_excel:
-            if record not in list_records:
-                db_insert_record(cur, MARKER_TBL_NAME, record)
-            else:
-                continue
+    try:
+        with db_write_cursor(DB_NAME_PATH) as cur:
+            report = import_markers(
+                cur, MARKER_TBL_NAME, excel_file_name, progress=show_progress
+            )
     except sqlite3.DatabaseError as err:
         print(f"Ошибка базы данных: {err}")
+    except (ValueError, KeyError) as err:
+        st.error(f"Не удалось прочитать файл маркеров: {err}")
     else:
-        st.success("Маркеры успешны добавлены!")
-        conn.commit()
-    finally:
-        cur.close()
-        conn.close()
+        progress_bar.progress(1.0)
+        show_import_report(report)
+
+
+def show_import_report(report: ImportReport) -> NoReturn:
+    st.success(
+        f"Маркеры успешны добавлены! Строк в файле: {report.total}, "
+        f"добавлено: {report.inserted}, "
+        f"пропущено дубликатов: {report.skipped}, "
+        f"отклонено: {report.rejected} "
+        f"(за {report.elapsed:.2f} с)"
+    )
+    if report.rejects:
+        st.warning("Отклоненные строки файла")
+        st.dataframe(
+            pd.DataFrame(report.rejects, columns=["Номер строки", "Причина"])
+        )
 
 
-def render_folium_map():
+@traced()
+def render_map_html(map_obj: folium.Map) -> str:
+    """
+    Формирует HTML-представление карты так же, как folium_static
+    """
+    return folium.Figure().add_child(map_obj).render()
+
+
+@traced()
+def render_folium_map(map_html: str):
     annotation_css(
         "Для навигации по карте можно использовать "
         "компоненты ZoomIn (+), ZoomOut (-) и Drag",
         clr="#C9D6DF",
     )
-    folium_static(  # NB! требуется для отображения карты в Streamlit
-        main_map, width=1050, height=550
-    )
+    # NB! требуется для отображения карты в Streamlit
+    components.html(map_html, width=MAP_WIDTH, height=MAP_HEIGHT + 10)
 
 
 def plotly_pie() -> NoReturn:
-    df = pd.DataFrame(
-        {
-            "values": np.random.randint(1000, 5000, size=8),
-            "markers": [
-                "Югорск",
-                "Надым",
-                "Ухта",
-                "Тюмень",
-                "Томск",
-                "Уфа",
-                "Тимашевск",
-                "Москва",
-            ],
-        }
-    )
+    """
+    Круговая диаграмма суммарного значения показателя по категориям
+    """
+    import plotly.graph_objects as go
+
+    df = get_aggregates(DB_NAME_PATH, MARKER_TBL_NAME, ("descr_pattern",))
     # fig = px.pie(df, values="values", names="markers", title="Распределение",
     #              color_discrete_sequence=px.colors.sequential.Bluyl_r)
     fig = go.Figure(
         data=[
             go.Pie(
-                labels=df["markers"],
-                values=df["values"],
+                labels=df["descr_pattern"],
+                values=df["total_value"],
                 scalegroup="one",
                 hole=0.3,
             )
@@ -265,59 +383,67 @@ def plotly_pie() -> NoReturn:
 
 
 def plotly_lines() -> NoReturn:
-    df = pd.DataFrame(
-        {
-            "lom": np.random.randint(1000, 5000, size=8),
-            "bu": np.random.randint(10000, 50000, size=8),
-            "markers": [
-                "Югорск",
-                "Надым",
-                "Ухта",
-                "Тюмень",
-                "Томск",
-                "Уфа",
-                "Тимашевск",
-                "Москва",
-            ],
-        }
+    """
+    Суммарное значение показателя по филиалам, по линии на категорию
+    """
+    import plotly.graph_objects as go
+
+    df = get_aggregates(
+        DB_NAME_PATH, MARKER_TBL_NAME, ("region", "descr_pattern")
     )
     fig = go.Figure()
-    fig.add_trace(
-        go.Scatter(
-            x=df["markers"], y=df["lom"], mode="lines+markers", name=None
-        )
-    )
-    fig.add_trace(
-        go.Scatter(
-            x=df["markers"], y=df["bu"], mode="lines+markers", name=None
+    for descr_pattern, df_pattern in df.groupby("descr_pattern"):
+        fig.add_trace(
+            go.Scatter(
+                x=df_pattern["region"],
+                y=df_pattern["total_value"],
+                mode="lines+markers",
+                name=descr_pattern,
+            )
         )
+    st.sidebar.plotly_chart(fig, use_container_width=True)
+
+
+def plotly_bars() -> NoReturn:
+    """
+    Число маркеров и суммарное значение показателя по цветам маркеров
+    """
+    import plotly.graph_objects as go
+
+    df = get_aggregates(DB_NAME_PATH, MARKER_TBL_NAME, ("marker_clr",))
+    fig = go.Figure(
+        data=[
+            go.Bar(
+                x=df["marker_clr"],
+                y=df["total_value"],
+                text=df["num_markers"],
+                marker_color=[
+                    colors_for_marker.get(clr, "gray")
+                    for clr in df["marker_clr"]
+                ],
+            )
+        ]
     )
     st.sidebar.plotly_chart(fig, use_container_width=True)
 
 
-def marker_creator(
-    # map_obj: folium.Map,
-    longitude: float,
-    latitude: float,
-    marker_name: str,
-    descr: str,
-    marker_value: float,
-    marker_clr: str,
-) -> NoReturn:
-    popup = f"""
-        <table rules="rows" col=2 width="255">
-          <tr><td><i>Имя маркера</i></td><td><i><b>{marker_name}</b></i></td></tr>
-          <tr><td><i>Категория</i></td><td>{descr}</td></tr>
-          <tr><td><i>Значение показателя</i></td><td>{marker_value:.1f}, [т]</td></tr>
-        </table>
-        """
-    marker_clr = colors_for_marker[marker_clr]
-    folium.Marker(
-        location=[longitude, latitude],
-        popup=popup,
-        parse_html=True,
-        icon=folium.Icon(color=marker_clr, icon="fa-cogs", prefix="fa"),
-    ).add_to(main_map)
+def analytics_elements():
+    annotation_css_sidebar(
+        "Аналитика по базе данных маркеров",
+        align="left",
+        size=18,
+        clr="#1E2022",
+    )
+    # plotly загружается только при первом показе диаграмм
+    if not st.sidebar.checkbox("Показать диаграммы"):
+        return
+
+    try:
+        plotly_pie()
+        plotly_lines()
+        plotly_bars()
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
 
 
 def map_creator(
@@ -333,7 +459,7 @@ def map_creator(
         zoom_start=zoom_start,
         scrollWheelZoom=True,
         # maxBounds=[[40, 68],[6, 97]],
-        tiles="OpenStreetMap",
+        tiles=MAP_TILES,
         dragging=True,
     )
     return main_map
@@ -346,27 +472,25 @@ def create_record_in_database(
     descr_pattern: str,
     marker_value: float,
     marker_clr: str,
+    attributes: Optional[dict] = None,
 ) -> NoReturn:
+    record = (
+        longitude,
+        latitude,
+        marker_name.upper(),
+        descr_pattern,
+        round_marker_value(marker_value),
+        marker_clr,
+    )
     try:
-        conn, cur = db_conn_cursor(DB_NAME_PATH)
-        # db_create_table(cur, MARKER_TBL_NAME)
-
-        list_records = db_read_table(cur, MARKER_TBL_NAME)
-        # список записей таблицы без индекса
-        list_records_wo_id = [record[1:] for record in list_records]
-
-        record = (
-            longitude,
-            latitude,
-            marker_name.upper(),
-            descr_pattern,
-            float(f"{marker_value:.1f}"),
-            marker_clr,
-        )
-        if record not in list_records_wo_id:
-            db_insert_record(cur, MARKER_TBL_NAME, record)
-        else:
-            raise RowsAlreadyExists("Такая запись уже существует")
+        with db_write_cursor(DB_NAME_PATH) as cur:
+            # дубликат отсекается уникальным индексом таблицы
+            if not db_insert_record(cur, MARKER_TBL_NAME, record):
+                raise RowsAlreadyExists("Такая запись уже существует")
+            if attributes:
+                db_set_attributes(
+                    cur, MARKER_TBL_NAME, cur.lastrowid, attributes
+                )
 
     except sqlite3.DatabaseError as err:
         print(f"Ошбика база данных: {err}")
@@ -374,41 +498,95 @@ def create_record_in_database(
         print(f"Запись {record} уже существует!")
     else:
         st.success(f"Запись {record} успешно добавлена в базу данных!")
-        conn.commit()
-    finally:
-        cur.close()
-        conn.close()
 
 
-def delete_record_from_database(marker_name: str) -> NoReturn:
+def delete_records_from_database(**criteria) -> NoReturn:
+    """
+    Удаляет маркеры, отобранные по условиям criteria (см.
+    db_delete_records), одной транзакцией
+    """
     try:
-        conn, cur = db_conn_cursor(DB_NAME_PATH)
-        list_records = db_read_table(cur, MARKER_TBL_NAME)
-
-        # список имен маркеров
-        list_marker_names = [
-            Record(*elem).marker_name for elem in list_records
-        ]
-        if marker_name in list_marker_names:
-            db_delete_record(cur, MARKER_TBL_NAME, marker_name)
-        else:
-            raise MarkerNameError(
-                f"Маркера '{marker_name.upper()}' нет в базе данных!"
-            )
+        with db_write_cursor(DB_NAME_PATH) as cur:
+            num_deleted = db_delete_records(cur, MARKER_TBL_NAME, **criteria)
     except sqlite3.DatabaseError as err:
         print(f"Ошибка базы данных: {err}")
-    except MarkerNameError as err:
-        print(err)
     else:
-        st.success("Запись успешно удалена из базы данных!")
-        conn.commit()
-        put_markers_on_map()
-    finally:
-        cur.close()
-        conn.close()
+        if num_deleted:
+            st.success(f"Из базы данных удалено маркеров: {num_deleted}")
+        else:
+            st.warning("Маркеров, удовлетворяющих условиям, не найдено")
 
 
-def sidebar_elements():
+def delete_markers_elements():
+    """
+    Создает элементы удаления маркеров: по именам, по категориям или в
+    прямоугольнике координат
+    """
+    annotation_css_sidebar(
+        "Удалить маркеры",
+        align="left",
+        size=15,
+        clr="#52616B",
+    )
+    try:
+        snapshot = get_marker_snapshot(DB_NAME_PATH, MARKER_TBL_NAME)
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+        return
+
+    mode = st.sidebar.radio(
+        "Отбор маркеров для удаления",
+        ("По именам", "По категориям", "В прямоугольнике координат"),
+    )
+    criteria = {}
+    if mode == "По именам":
+        criteria["marker_names"] = st.sidebar.multiselect(
+            "Выберите имена маркеров для удаления",
+            options=snapshot.marker_names,
+        )
+    else:
+        categories = st.sidebar.multiselect(
+            "Категории маркеров для удаления",
+            options=sorted(snapshot.categories),
+        )
+        if categories:
+            criteria["categories"] = categories
+        if mode == "В прямоугольнике координат":
+            min_longitude = st.sidebar.number_input(
+                "Долгота от", value=55.0, format="%3f"
+            )
+            max_longitude = st.sidebar.number_input(
+                "Долгота до", value=56.0, format="%3f"
+            )
+            min_latitude = st.sidebar.number_input(
+                "Широта от", value=37.0, format="%3f"
+            )
+            max_latitude = st.sidebar.number_input(
+                "Широта до", value=38.0, format="%3f"
+            )
+            criteria["bbox"] = (
+                min_longitude,
+                max_longitude,
+                min_latitude,
+                max_latitude,
+            )
+        if not criteria:
+            return
+        # удаление по условию может затронуть много маркеров
+        if not st.sidebar.checkbox("Подтверждаю удаление отобранных маркеров"):
+            return
+
+    if st.sidebar.button("Удалить маркеры из базы данных"):
+        if mode != "По именам" or criteria["marker_names"]:
+            delete_records_from_database(**criteria)
+
+
+@traced()
+def sidebar_elements() -> Optional[Tuple]:
+    """
+    Создает элементы боковой панели. Возвращает параметры потоков грузов
+    для карты (см. logistics_elements)
+    """
     annotation_css_sidebar(
         "Сводные отчеты",
         align="left",
@@ -416,12 +594,19 @@ def sidebar_elements():
         clr="#1E2022",
     )
     selected_type_report = st.sidebar.radio(
-        "Выберите формат отчета",
-        ("Excel (табличное представление)", "LaTeX (аналитика)"),
+        "Выберите формат отчета", REPORT_FORMATS
     )
 
     if st.sidebar.button("Подготовить отчет"):
-        pass
+        # идентификатор задания хранится в адресе страницы сессии
+        job_id = submit_report(
+            DB_NAME_PATH, MARKER_TBL_NAME, selected_type_report
+        )
+        st.experimental_set_query_params(report_job=job_id)
+
+    report_status_elements()
+
+    analytics_elements()
 
     annotation_css_sidebar(
         "Работа с базой данных маркеров слоя",
@@ -430,11 +615,15 @@ def sidebar_elements():
         clr="#1E2022",
     )
 
+    export_format = st.sidebar.selectbox(
+        "Выберите формат выгрузки", EXPORT_FORMATS
+    )
     if st.sidebar.button("Выгрузить базу данных маркеров"):
-        print("База данных успешно выгружена в текущую директорию")
+        export_database_elements(export_format)
 
     if st.sidebar.button("Обновить базу данных маркеров"):
-        put_markers_on_map()
+        # маркеры будут перечитаны из базы данных при отрисовке карты
+        invalidate_marker_snapshot(DB_NAME_PATH)
 
     # --- ОПАСНЫЙ ФРАГМЕНТ ---
     if st.sidebar.button("Удалить базу данных"):
@@ -477,6 +666,8 @@ def sidebar_elements():
         "Введите значение показателя, [т]", value=6530.324, format="%3f"
     )
 
+    attributes = category_fields_elements(descr_pattern)
+
     if st.sidebar.button("Добавить маркер в базу данных"):
         create_record_in_database(
             longitude,
@@ -485,105 +676,567 @@ def sidebar_elements():
             descr_pattern,
             marker_value,
             marker_clr,
+            attributes,
         )
 
+    category_field_editor_elements(descr_pattern)
+
+    delete_markers_elements()
+    nearby_markers_elements()
+    attribute_filter_elements()
+    return logistics_elements()
+
+
+def logistics_elements() -> Optional[Tuple]:
+    """
+    Создает элементы расчета логистических показателей: назначение
+    маркеров на ближайшие площадки и оптимальное распределение груза по
+    площадкам. Возвращает параметры потоков грузов для карты или None
+    """
     annotation_css_sidebar(
-        "Удалить один маркер слоя по имени",
+        "Логистические показатели", align="left", size=18, clr="#1E2022"
+    )
+    try:
+        snapshot = get_marker_snapshot(DB_NAME_PATH, MARKER_TBL_NAME)
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+        return None
+
+    all_categories = sorted(snapshot.categories)
+    source_categories = tuple(
+        st.sidebar.multiselect(
+            "Откуда вывозится груз",
+            options=all_categories,
+            default=[c for c in SOURCE_CATEGORIES if c in all_categories],
+        )
+    )
+    facility_categories = tuple(
+        st.sidebar.multiselect(
+            "Площадки приема",
+            options=all_categories,
+            default=[c for c in FACILITY_CATEGORIES if c in all_categories],
+        )
+    )
+    time_budget = st.sidebar.number_input(
+        "Предел времени расчета перевозок, [с]",
+        min_value=1.0,
+        value=SOLVER_TIME_BUDGET,
+    )
+    show_flows = st.sidebar.checkbox("Показывать потоки грузов на карте")
+
+    try:
+        if st.sidebar.button("Назначить ближайшие площадки"):
+            assignment = get_facility_assignment(
+                DB_NAME_PATH,
+                MARKER_TBL_NAME,
+                source_categories,
+                facility_categories,
+            )
+            st.markdown(
+                "_Назначение ближайших площадок: суммарный грузооборот "
+                f"{assignment[assignment_labels[-1]].sum():.1f}, [т*км]_"
+            )
+            st.dataframe(assignment)
+
+        if st.sidebar.button("Рассчитать оптимальные перевозки"):
+            plan = get_transport_plan(
+                DB_NAME_PATH,
+                MARKER_TBL_NAME,
+                source_categories,
+                facility_categories,
+                time_budget,
+            )
+            st.markdown(
+                f"_План перевозок ({plan.method}): суммарный грузооборот "
+                f"{plan.flows[flow_labels[-1]].sum():.1f}, [т*км]_"
+            )
+            st.dataframe(plan.flows)
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+    except ValueError as err:
+        st.sidebar.warning(str(err))
+
+    if not show_flows:
+        return None
+    return source_categories, facility_categories, time_budget
+
+
+def category_fields_elements(descr_pattern: str) -> dict:
+    """
+    Создает поля ввода дополнительных полей категории descr_pattern.
+    Возвращает словарь значений полей
+    """
+    try:
+        with db_read_cursor(DB_NAME_PATH) as cur:
+            fields = db_category_fields(cur, MARKER_TBL_NAME, descr_pattern)
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+        return {}
+
+    attributes = {}
+    for _, name, field_type, label in fields:
+        if field_type == FIELD_REAL:
+            attributes[name] = st.sidebar.number_input(
+                label, value=0.0, format="%3f", key=f"field_{name}"
+            )
+        else:
+            attributes[name] = (
+                st.sidebar.text_input(label, key=f"field_{name}") or None
+            )
+    return attributes
+
+
+def category_field_editor_elements(descr_pattern: str):
+    """
+    Создает элементы добавления дополнительного поля в набор полей
+    категории descr_pattern
+    """
+    annotation_css_sidebar(
+        f"Дополнительные поля категории '{descr_pattern}'",
         align="left",
         size=15,
         clr="#52616B",
     )
+    name = st.sidebar.text_input("Имя поля (латиницей)")
+    label = st.sidebar.text_input("Подпись поля")
+    field_type = st.sidebar.selectbox(
+        "Тип поля",
+        FIELD_TYPES,
+        format_func=lambda field_type: (
+            "Число" if field_type == FIELD_REAL else "Текст"
+        ),
+    )
+    if st.sidebar.button("Добавить поле категории") and name.strip():
+        try:
+            with db_write_cursor(DB_NAME_PATH) as cur:
+                db_add_category_field(
+                    cur,
+                    MARKER_TBL_NAME,
+                    descr_pattern,
+                    name.strip(),
+                    field_type,
+                    label.strip() or name.strip(),
+                )
+        except sqlite3.DatabaseError as err:
+            print(f"Ошбика база данных: {err}")
+        else:
+            st.sidebar.success(f"Поле {name} добавлено")
+
 
+def attribute_filter_elements():
+    """
+    Создает элементы отбора маркеров по значению дополнительного поля
+    """
     try:
-        conn, cur = db_conn_cursor(DB_NAME_PATH)
-        list_records = db_read_table(cur, MARKER_TBL_NAME)
+        with db_read_cursor(DB_NAME_PATH) as cur:
+            fields = db_category_fields(cur, MARKER_TBL_NAME)
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+        return
+    if not fields:
+        return
 
-        # список записей таблицы без индекса
-        list_avaible_marker_name = [
-            Record(*record).marker_name for record in list_records
-        ]
-        marker_name_for_del = st.sidebar.selectbox(
-            "Выберите имя маркера для удаления",
-            options=list_avaible_marker_name,
+    annotation_css_sidebar(
+        "Отбор маркеров по дополнительному полю",
+        align="left",
+        size=15,
+        clr="#52616B",
+    )
+    # одно и то же поле может входить в наборы нескольких категорий
+    field_types = {name: field_type for _, name, field_type, _ in fields}
+    labels = {name: label for _, name, _, label in fields}
+    name = st.sidebar.selectbox(
+        "Дополнительное поле",
+        sorted(field_types),
+        format_func=lambda name: labels[name],
+    )
+    filter_params = {}
+    if field_types[name] == FIELD_REAL:
+        filter_params["min_value"] = st.sidebar.number_input(
+            "Не менее", value=0.0, format="%3f"
+        )
+        filter_params["max_value"] = st.sidebar.number_input(
+            "Не более", value=1000.0, format="%3f"
         )
+    else:
+        filter_params["equals"] = st.sidebar.text_input("Равно")
+    if not st.sidebar.button("Отобрать маркеры"):
+        return
+
+    try:
+        with db_read_cursor(DB_NAME_PATH) as cur:
+            found = db_filter_by_attribute(
+                cur, MARKER_TBL_NAME, name, **filter_params
+            )
     except sqlite3.DatabaseError as err:
         print(f"Ошбика база данных: {err}")
+        return
+
+    st.markdown(f"_Маркеры по полю '{labels[name]}'_")
+    st.dataframe(
+        pd.DataFrame(
+            [record[1:] for record in found],
+            columns=record_labels + [labels[name]],
+        )
+    )
+
+
+def nearby_markers_elements():
+    """
+    Создает элементы поиска маркеров в радиусе и ближайших маркеров
+    """
+    annotation_css_sidebar(
+        "Поиск маркеров рядом с объектом",
+        align="left",
+        size=15,
+        clr="#52616B",
+    )
+    try:
+        snapshot = get_marker_snapshot(DB_NAME_PATH, MARKER_TBL_NAME)
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+        return
+
+    center_name = st.sidebar.selectbox(
+        "Выберите маркер в центре поиска", options=snapshot.marker_names
+    )
+    radius_km = st.sidebar.number_input(
+        "Радиус поиска, [км]", min_value=0.0, value=50.0
+    )
+    num_nearest = st.sidebar.number_input(
+        "Число ближайших маркеров", min_value=1, value=5
+    )
+    search_radius = st.sidebar.button("Найти маркеры в радиусе")
+    search_nearest = st.sidebar.button("Найти ближайшие маркеры")
+    if center_name is None or not (search_radius or search_nearest):
+        return
+
+    center = snapshot.find(center_name)
+    try:
+        with db_read_cursor(DB_NAME_PATH) as cur:
+            if search_radius:
+                found = db_select_radius(
+                    cur,
+                    MARKER_TBL_NAME,
+                    center.longitude,
+                    center.latitude,
+                    radius_km,
+                )
+            else:
+                # сам маркер в центре поиска не учитывается
+                found = db_select_nearest(
+                    cur,
+                    MARKER_TBL_NAME,
+                    center.longitude,
+                    center.latitude,
+                    num_nearest + 1,
+                )
+                found = [item for item in found if item[0][0] != center.id]
+                found = found[:num_nearest]
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+        return
+
+    st.markdown(f"_Маркеры рядом с объектом {center_name}_")
+    st.dataframe(
+        pd.DataFrame(
+            [record[1:] + (distance,) for record, distance in found],
+            columns=record_labels + ["Расстояние, [км]"],
+        )
+    )
+
+
+def export_database_elements(export_format: str):
+    """
+    Выгружает базу данных маркеров в каталог EXPORTS_DIR на сервере,
+    отображая ход выгрузки, и выводит ссылку на файл выгрузки, если он не
+    больше MAX_DOWNLOAD_SIZE
+    """
+    progress_bar = st.sidebar.progress(0)
+    try:
+        file_name = export_database(
+            DB_NAME_PATH,
+            MARKER_TBL_NAME,
+            export_format,
+            EXPORTS_DIR,
+            progress=progress_bar.progress,
+        )
+    except (sqlite3.DatabaseError, OSError) as err:
+        st.sidebar.error(f"Не удалось выгрузить базу данных: {err}")
+        return
+
+    st.sidebar.success(f"База данных успешно выгружена в {file_name}")
+    if file_name.stat().st_size <= MAX_DOWNLOAD_SIZE:
+        download_link_css_sidebar(
+            file_name.read_bytes(),
+            file_name.name,
+            f"Скачать {file_name.name}",
+            clr="#52616B",
+        )
     else:
-        put_markers_on_map()
-    finally:
-        cur.close()
-        conn.close()
+        st.sidebar.info(
+            "Файл выгрузки слишком велик для скачивания через браузер и "
+            "доступен в каталоге выгрузок на сервере"
+        )
 
-    if st.sidebar.button("Удалить маркер из базы данных"):
-        if marker_name_for_del is not None:
-            delete_record_from_database(marker_name_for_del.upper())
+
+def report_status_elements():
+    """
+    Отображает ход подготовки последнего отчета сессии и по нажатию
+    кнопки -- ссылку на готовый отчет
+    """
+    job_ids = st.experimental_get_query_params().get("report_job")
+    job = get_report_job(job_ids[0]) if job_ids else None
+    if job is None:
+        return
+
+    if job.status in (JOB_PENDING, JOB_RUNNING):
+        st.sidebar.progress(job.progress)
+        st.sidebar.info(
+            f"Отчет {job.status}... Нажмите 'Обновить статус отчета'"
+        )
+        st.sidebar.button("Обновить статус отчета")
+    elif job.status == JOB_FAILED:
+        st.sidebar.error(f"Не удалось подготовить отчет: {job.error}")
+    elif st.sidebar.button("Скачать отчет"):
+        # файл отчета передается в браузер только по запросу, а не при
+        # каждом перезапуске сценария
+        report_file = pathlib2.Path(job.path)
+        try:
+            data = report_file.read_bytes()
+        except OSError:
+            st.sidebar.error("Файл отчета не найден. Подготовьте отчет заново")
+            return
+        download_link_css_sidebar(
+            data,
+            report_file.name,
+            f"Скачать отчет {report_file.name}",
+            clr="#52616B",
+        )
 
 
 def delete_database() -> NoReturn:
     """
-    Удаляет базу данных
+    Очищает базу данных маркеров: пересоздает схему в одной транзакции,
+    закрывает соединения пула и сбрасывает кэши
     """
-    db_file = pathlib2.Path(DB_NAME_PATH)
-    if db_file.exists():
-        try:
-            # небезопасный временный вариант
-            # удаляет базу данных в облаке с ОС Linux
-            output = subprocess.call(f"rm -f {db_file}", shell=True)
-        except FileNotFoundError as err:
-            print(err)
-        else:
-            print(f"Результат команды удаления базы данных: {output}")
-            st.warning(
-                "База данных удалена! Нажмите кнопку 'Обновить базу данных маркеров'"
+    try:
+        with db_write_cursor(DB_NAME_PATH) as cur:
+            db_reset_table(cur, MARKER_TBL_NAME)
+    except sqlite3.DatabaseError as err:
+        print(f"Ошибка базы данных: {err}")
+    else:
+        get_connection_manager(DB_NAME_PATH).close()
+        map_html_cache.clear()
+        st.warning("База данных маркеров очищена!")
+
+
+@traced()
+def map_settings_elements(transport: Optional[Tuple] = None) -> MapSettings:
+    """
+    Создает элементы боковой панели с параметрами отображения карты.
+    transport -- параметры потоков грузов (см. logistics_elements)
+    """
+    annotation_css_sidebar(
+        "Параметры карты", align="left", size=18, clr="#1E2022"
+    )
+    render_mode = st.sidebar.selectbox(
+        "Режим отображения маркеров", RENDER_MODES
+    )
+    longitude = st.sidebar.number_input(
+        "Долгота центра карты", value=55.6787825, format="%3f"
+    )
+    latitude = st.sidebar.number_input(
+        "Широта центра карты", value=37.79647853, format="%3f"
+    )
+    zoom_start = st.sidebar.slider(
+        "Масштаб карты", min_value=3, max_value=18, value=14
+    )
+    viewport_only = st.sidebar.checkbox(
+        "Показывать только маркеры в области просмотра"
+    )
+    categories = visible_categories = ()
+    try:
+        snapshot = get_marker_snapshot(DB_NAME_PATH, MARKER_TBL_NAME)
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+    else:
+        all_categories = sorted(snapshot.categories)
+        # маркеры невыбранных категорий не передаются в браузер
+        categories = tuple(
+            st.sidebar.multiselect(
+                "Категории маркеров на карте",
+                options=all_categories,
+                default=all_categories,
             )
+        )
+        # слои остальных выбранных категорий выключены при загрузке и
+        # строятся в браузере при включении в панели слоев
+        visible_categories = tuple(
+            st.sidebar.multiselect(
+                "Слои, включенные при загрузке карты",
+                options=categories,
+                default=categories,
+            )
+        )
+
+    # найденный маркер становится центром карты
+    found_record = marker_search_elements()
+    if found_record is not None:
+        longitude, latitude = found_record.longitude, found_record.latitude
+
+    return MapSettings(
+        longitude,
+        latitude,
+        zoom_start,
+        render_mode,
+        viewport_only,
+        categories,
+        visible_categories,
+        transport,
+    )
 
 
-def put_markers_on_map():
+def marker_search_elements() -> Optional[Record]:
     """
-    Наносит марекры на карту
+    Создает элементы поиска маркера по имени и категории.
+    Возвращает выбранный маркер или None
     """
+    query = st.sidebar.text_input("Поиск маркера на карте (имя, категория)")
+    if not query.strip():
+        return None
+
     try:
-        conn, cur = db_conn_cursor(DB_NAME_PATH)
-        list_records = db_read_table(cur, MARKER_TBL_NAME)
-
-        if list_records:
-            for record in list_records:
-                from_record2_nt = Record(*record)
-                lon = from_record2_nt.longitude
-                lat = from_record2_nt.latitude
-                marker_name = from_record2_nt.marker_name
-                descr_pattern = from_record2_nt.descr_pattern
-                marker_value = from_record2_nt.marker_value
-                marker_clr = from_record2_nt.marker_clr
-
-                marker_creator(
-                    lon,
-                    lat,
-                    marker_name,
-                    descr_pattern,
-                    marker_value,
-                    marker_clr,
-                )
-        else:
+        with db_read_cursor(DB_NAME_PATH) as cur:
+            found = db_search_markers(cur, MARKER_TBL_NAME, query)
+    except sqlite3.DatabaseError as err:
+        print(f"Ошбика база данных: {err}")
+        return None
+
+    if not found:
+        st.sidebar.info("Маркеры не найдены")
+        return None
+
+    record = st.sidebar.selectbox(
+        "Найденные маркеры",
+        options=[Record(*record) for record in found],
+        format_func=lambda record: (
+            f"{record.marker_name} ({record.descr_pattern})"
+        ),
+    )
+    return record
+
+
+@traced()
+def put_markers_on_map(map_settings: MapSettings):
+    """
+    Наносит марекры на карту в выбранном режиме отображения: по одному
+    слою на каждую выбранную категорию
+    """
+    try:
+        snapshot = get_marker_snapshot(DB_NAME_PATH, MARKER_TBL_NAME)
+        if not len(snapshot):
             raise EmptyDatabase("Пока в базе нет ни одного маркера...")
 
+        if map_settings.viewport_only:
+            snapshot = snapshot.within(
+                *viewport_bounds(
+                    map_settings.longitude,
+                    map_settings.latitude,
+                    map_settings.zoom_start,
+                )
+            )
+        for layer in category_layers(
+            snapshot,
+            map_settings.categories,
+            clustered=map_settings.render_mode == RENDER_CLUSTERS,
+            visible_categories=map_settings.visible_categories,
+        ):
+            layer.add_to(main_map)
+
+        if map_settings.transport is not None:
+            plan = get_transport_plan(
+                DB_NAME_PATH, MARKER_TBL_NAME, *map_settings.transport
+            )
+            flow_layer(plan.lines).add_to(main_map)
+
     except sqlite3.DatabaseError as err:
         print(f"Ошбика база данных: {err}")
     except EmptyDatabase as err:
         print(err)
-    finally:
-        cur.close()
-        conn.close()
+    except ValueError as err:  # потоки грузов не рассчитаны
+        print(err)
 
 
 def start_load_markers():
     create_markers_from_excel("./additional_files/added_markers.xlsx")
 
 
+def debug_panel_elements(trace: Optional[Trace]):
+    """
+    Выводит замеры этапов перезапуска сценария и ссылки на их выгрузку
+    """
+    if trace is None:
+        return
+
+    annotation_css_sidebar(
+        "Отладочная панель", align="left", size=18, clr="#1E2022"
+    )
+    st.sidebar.markdown(
+        f"Запросов к базе данных: {trace.queries}, строк: {trace.rows}"
+    )
+    st.sidebar.dataframe(
+        pd.DataFrame(
+            [
+                (
+                    ". " * item.depth + item.name,
+                    item.seconds * 1000,
+                    item.queries,
+                    item.rows,
+                )
+                for item in trace.spans
+                if item is not None
+            ],
+            columns=["Этап", "Время, [мс]", "Запросы", "Строки"],
+        )
+    )
+    download_link_css_sidebar(
+        trace_json(trace).encode("utf-8"),
+        "trace.json",
+        "Скачать замеры перезапуска (JSON)",
+    )
+    download_link_css_sidebar(
+        prometheus_text(recent_traces()).encode("utf-8"),
+        "metrics.txt",
+        "Скачать метрики последних перезапусков (Prometheus)",
+    )
+
+
 if __name__ == "__main__":
+    start_rerun(st.sidebar.checkbox("Отладочная панель (замеры этапов)"))
     init_db()  # инициализация базы данных
-    main_map = map_creator()
     main_elements()
-    sidebar_elements()
-    put_markers_on_map()
-    render_folium_map()
+    transport = sidebar_elements()
+    map_settings = map_settings_elements(transport)
+
+    # карта перестраивается только при изменении маркеров или параметров
+    with span("map_cache_lookup"):
+        map_key = map_cache_key(
+            get_marker_snapshot(DB_NAME_PATH, MARKER_TBL_NAME),
+            map_settings,
+            MAP_TILES,
+        )
+        map_html = map_html_cache.get(map_key)
+    if map_html is None:
+        with span("build_map"):
+            main_map = map_creator(
+                map_settings.longitude,
+                map_settings.latitude,
+                map_settings.zoom_start,
+            )
+            put_markers_on_map(map_settings)
+            folium.LayerControl().add_to(main_map)
+            map_html = render_map_html(main_map)
+            map_html_cache.put(map_key, map_html)
+    render_folium_map(map_html)
+    debug_panel_elements(finish_rerun())
@@ -0,0 +1,469 @@
+import multiprocessing
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+
+from database import EARTH_RADIUS_KM
+from instrumentation import traced
+from markers import MarkerSnapshot, get_marker_snapshot
+
+# категории маркеров по умолчанию: откуда вывозится груз и куда
+SOURCE_CATEGORIES = ("Лом", "Труба б/у")
+FACILITY_CATEGORIES = ("Площадки по отходам",)
+
+BLOCK_CELLS = 2**20  # число элементов одного блока матрицы расстояний
+MAX_MATRIX_CELLS = 16 * 2**20  # предел полной матрицы расстояний
+
+MAX_CACHED_RESULTS = 16  # число хранимых назначений и планов перевозок
+SOLVER_TIME_BUDGET = 30.0  # предел времени решения задачи ЛП, [с]
+LP_MAX_VARIABLES = 250000  # задачи большего размера решаются эвристикой
+
+# методы решения транспортной задачи
+METHOD_LP = "линейное программирование"
+METHOD_GREEDY = "жадная эвристика"
+
+TransportPlan = namedtuple("TransportPlan", ["method", "flows", "lines"])
+
+# подписи колонок таблицы назначения площадок
+assignment_labels = [
+    "Имя маркера",
+    "Категория",
+    "Значение показателя",
+    "Площадка",
+    "Расстояние, [км]",
+    "Грузооборот, [т*км]",
+]
+
+
+# подписи колонок таблицы потоков грузов
+flow_labels = [
+    "Откуда",
+    "Куда",
+    "Груз, [т]",
+    "Расстояние, [км]",
+    "Грузооборот, [т*км]",
+]
+
+
+def category_mask(
+    snapshot: MarkerSnapshot, categories: Tuple[str, ...]
+) -> np.ndarray:
+    """
+    Возвращает маску маркеров снимка, относящихся к категориям categories
+    """
+    codes = [
+        code
+        for code, category in enumerate(snapshot.categories)
+        if category in categories
+    ]
+    return np.isin(snapshot.descr_code, codes)
+
+
+def haversine_array(
+    longitude1: np.ndarray,
+    latitude1: np.ndarray,
+    longitude2: np.ndarray,
+    latitude2: np.ndarray,
+) -> np.ndarray:
+    """
+    Поэлементные расстояния по большому кругу между маркерами, [км].
+    Массивы координат приводятся по правилам broadcasting NumPy;
+    координаты интерпретируются так же, как в database.haversine_km
+    """
+    phi1, phi2 = np.radians(longitude1), np.radians(longitude2)
+    d_lambda = np.radians(latitude2) - np.radians(latitude1)
+    a = (
+        np.sin((phi2 - phi1) / 2) ** 2
+        + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def haversine_matrix(
+    longitude1: np.ndarray,
+    latitude1: np.ndarray,
+    longitude2: np.ndarray,
+    latitude2: np.ndarray,
+) -> np.ndarray:
+    """
+    Матрица расстояний по большому кругу между маркерами двух наборов,
+    [км]
+    """
+    return haversine_array(
+        longitude1[:, np.newaxis],
+        latitude1[:, np.newaxis],
+        longitude2[np.newaxis, :],
+        latitude2[np.newaxis, :],
+    )
+
+
+def iter_distance_blocks(
+    sources: MarkerSnapshot,
+    targets: MarkerSnapshot,
+    block_cells: int = BLOCK_CELLS,
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Вычисляет матрицу расстояний от маркеров sources до маркеров targets
+    блоками строк не более block_cells элементов и выдает пары
+    (номер первой строки блока, блок расстояний). Память не зависит от
+    числа маркеров sources
+    """
+    block_rows = max(1, block_cells // max(len(targets), 1))
+    for start in range(0, len(sources), block_rows):
+        stop = start + block_rows
+        yield start, haversine_matrix(
+            sources.longitude[start:stop],
+            sources.latitude[start:stop],
+            targets.longitude,
+            targets.latitude,
+        )
+
+
+def distance_matrix(
+    sources: MarkerSnapshot, targets: MarkerSnapshot
+) -> np.ndarray:
+    """
+    Полная матрица расстояний от маркеров sources до маркеров targets,
+    [км]. Размер матрицы ограничен MAX_MATRIX_CELLS; для больших наборов
+    следует использовать iter_distance_blocks
+    """
+    num_cells = len(sources) * len(targets)
+    if num_cells > MAX_MATRIX_CELLS:
+        raise ValueError(
+            f"Матрица расстояний {len(sources)}x{len(targets)} слишком велика"
+        )
+
+    matrix = np.empty((len(sources), len(targets)), dtype=np.float32)
+    for start, block in iter_distance_blocks(sources, targets):
+        matrix[start : start + len(block)] = block
+    return matrix
+
+
+def _unit_vectors(snapshot: MarkerSnapshot) -> np.ndarray:
+    phi = np.radians(snapshot.longitude)
+    lam = np.radians(snapshot.latitude)
+    return np.column_stack(
+        [np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)]
+    )
+
+
+def nearest_facilities(
+    sources: MarkerSnapshot, facilities: MarkerSnapshot
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Назначает каждому маркеру sources ближайшую площадку из facilities.
+    Поиск ведется по k-d дереву точек на единичной сфере: длина хорды
+    монотонна по расстоянию на сфере, поэтому ближайшая по хорде площадка
+    ближайшая и по большому кругу.
+
+    Возвращает номера площадок и расстояния до них, [км]
+    """
+    if not len(facilities):
+        raise ValueError("Нет ни одной площадки для назначения")
+
+    from scipy.spatial import cKDTree  # SciPy загружается при первом расчете
+
+    chord, index = cKDTree(_unit_vectors(facilities)).query(
+        _unit_vectors(sources)
+    )
+    distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1.0))
+    return index, distance
+
+
+# (база данных, таблица, категории) -> (версия, таблица); давно не
+# использованные назначения вытесняются (LRU)
+_assignments = OrderedDict()
+_assignments_lock = threading.Lock()
+
+
+@traced()
+def get_facility_assignment(
+    db_name: str,
+    tbl_name: str,
+    source_categories: Tuple[str, ...] = SOURCE_CATEGORIES,
+    facility_categories: Tuple[str, ...] = FACILITY_CATEGORIES,
+) -> pd.DataFrame:
+    """
+    Возвращает назначение маркеров категорий source_categories на
+    ближайшие площадки категорий facility_categories с расстоянием и
+    грузооборотом. Результат кэшируется до следующей версии снимка
+    маркеров
+    """
+    snapshot = get_marker_snapshot(db_name, tbl_name)
+    key = (db_name, tbl_name, source_categories, facility_categories)
+    with _assignments_lock:
+        cached = _assignments.get(key)
+        if cached is not None and cached[0] == snapshot.version:
+            _assignments.move_to_end(key)
+            return cached[1]
+
+    sources = snapshot.take(category_mask(snapshot, source_categories))
+    facilities = snapshot.take(category_mask(snapshot, facility_categories))
+    index, distance = nearest_facilities(sources, facilities)
+    assignment = pd.DataFrame(
+        dict(
+            zip(
+                assignment_labels,
+                (
+                    sources.marker_name,
+                    sources.descr_pattern(),
+                    sources.marker_value,
+                    facilities.marker_name[index],
+                    distance,
+                    sources.marker_value * distance,
+                ),
+            )
+        )
+    )
+    _cache_put(
+        _assignments, _assignments_lock, key, snapshot.version, assignment
+    )
+    return assignment
+
+
+def _check_supply(supply: np.ndarray, capacity: np.ndarray):
+    if not len(capacity):
+        raise ValueError("Нет ни одной площадки для распределения груза")
+    if supply.sum() > capacity.sum():
+        raise ValueError(
+            f"Суммарная вместимость площадок {capacity.sum():.1f}, [т] "
+            f"меньше объема груза {supply.sum():.1f}, [т]"
+        )
+
+
+def _solve_lp(
+    supply: np.ndarray, capacity: np.ndarray, cost: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Решает транспортную задачу: весь груз supply маркеров-источников
+    распределяется по площадкам вместимостью capacity с минимальным
+    грузооборотом sum(cost * x).
+
+    Возвращает номера источников, номера площадок и объемы потоков
+    """
+    from scipy import sparse
+    from scipy.optimize import linprog
+
+    num_sources, num_facilities = cost.shape
+    # x[i, j] -- объем груза от источника i на площадку j
+    a_eq = sparse.kron(
+        sparse.identity(num_sources), np.ones((1, num_facilities))
+    )
+    a_ub = sparse.kron(
+        np.ones((1, num_sources)), sparse.identity(num_facilities)
+    )
+    problem = dict(
+        c=cost.ravel(),
+        A_ub=a_ub.tocsr(),
+        b_ub=capacity,
+        A_eq=a_eq.tocsr(),
+        b_eq=supply,
+        bounds=(0, None),
+    )
+    try:
+        result = linprog(method="highs", **problem)
+    except ValueError:  # в SciPy до 1.6 метода highs нет
+        result = linprog(
+            method="interior-point", options={"sparse": True}, **problem
+        )
+    if not result.success:
+        raise ValueError(f"Задача ЛП не решена: {result.message}")
+
+    x = result.x.reshape(cost.shape)
+    source_index, facility_index = np.nonzero(x > 1e-6)
+    return source_index, facility_index, x[source_index, facility_index]
+
+
+def _lp_worker(conn, supply, capacity, cost):
+    try:
+        conn.send(("ok", _solve_lp(supply, capacity, cost)))
+    except Exception as err:  # ошибка передается вызывающему процессу
+        conn.send(("error", str(err)))
+    finally:
+        conn.close()
+
+
+def greedy_transport(
+    sources: MarkerSnapshot,
+    supply: np.ndarray,
+    facilities: MarkerSnapshot,
+    capacity: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Жадная эвристика транспортной задачи для больших наборов маркеров:
+    источники в порядке убывания объема груза отправляют груз на
+    ближайшие площадки с остатком вместимости. Расстояния вычисляются
+    блоками (см. iter_distance_blocks).
+
+    Возвращает номера источников, номера площадок и объемы потоков
+    """
+    order = np.argsort(-supply, kind="stable")
+    remaining = capacity.astype(np.float64).copy()
+    flows = []
+    for start, block in iter_distance_blocks(sources.take(order), facilities):
+        for row, distances in enumerate(block):
+            source = order[start + row]
+            left = supply[source]
+            for facility in np.argsort(distances):
+                if left <= 0:
+                    break
+                if remaining[facility] <= 0:
+                    continue
+                tons = min(left, remaining[facility])
+                remaining[facility] -= tons
+                left -= tons
+                flows.append((source, facility, tons))
+    if not flows:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.float64)
+
+    source_index, facility_index, tons = zip(*flows)
+    return np.array(source_index), np.array(facility_index), np.array(tons)
+
+
+def solve_transport(
+    sources: MarkerSnapshot,
+    facilities: MarkerSnapshot,
+    time_budget: float = SOLVER_TIME_BUDGET,
+) -> Tuple[str, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Распределяет груз маркеров sources (marker_value, [т]) по площадкам
+    facilities вместимостью marker_value, [т] с минимальным грузооборотом.
+
+    Задача ЛП решается в отдельном процессе; если решение не получено за
+    time_budget секунд или задача слишком велика, используется жадная
+    эвристика. Возвращает метод решения, номера источников, номера
+    площадок и объемы потоков
+    """
+    supply = sources.marker_value
+    capacity = facilities.marker_value
+    _check_supply(supply, capacity)
+
+    if len(sources) * len(facilities) <= LP_MAX_VARIABLES:
+        cost = distance_matrix(sources, facilities).astype(np.float64)
+        # spawn: дочерний процесс не наследует потоки и соединения сервера
+        context = multiprocessing.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_lp_worker,
+            args=(sender, supply, capacity, cost),
+            daemon=True,
+        )
+        process.start()
+        sender.close()
+        try:
+            if receiver.poll(time_budget):
+                status, result = receiver.recv()
+                if status == "ok":
+                    return (METHOD_LP, *result)
+                print(f"Транспортная задача: {result}")
+        except EOFError:  # процесс завершился, не передав результат
+            pass
+        finally:
+            receiver.close()
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    return (
+        METHOD_GREEDY,
+        *greedy_transport(sources, supply, facilities, capacity),
+    )
+
+
+# (база данных, таблица, категории) -> (версия, план, предел времени)
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+@traced()
+def get_transport_plan(
+    db_name: str,
+    tbl_name: str,
+    source_categories: Tuple[str, ...] = SOURCE_CATEGORIES,
+    facility_categories: Tuple[str, ...] = FACILITY_CATEGORIES,
+    time_budget: float = SOLVER_TIME_BUDGET,
+) -> TransportPlan:
+    """
+    Возвращает план перевозок груза маркеров категорий source_categories
+    на площадки категорий facility_categories: таблицу потоков и линии
+    потоков для карты ((начало, конец, груз, подпись)). План кэшируется
+    до следующей версии снимка маркеров; план жадной эвристики
+    пересчитывается, если предел времени time_budget больше того, с
+    которым он получен
+    """
+    snapshot = get_marker_snapshot(db_name, tbl_name)
+    key = (db_name, tbl_name, source_categories, facility_categories)
+    with _plans_lock:
+        cached = _plans.get(key)
+        if (
+            cached is not None
+            and cached[0] == snapshot.version
+            and (cached[1].method == METHOD_LP or cached[2] >= time_budget)
+        ):
+            _plans.move_to_end(key)
+            return cached[1]
+
+    sources = snapshot.take(category_mask(snapshot, source_categories))
+    facilities = snapshot.take(category_mask(snapshot, facility_categories))
+    method, source_index, facility_index, tons = solve_transport(
+        sources, facilities, time_budget
+    )
+    distance = haversine_array(
+        sources.longitude[source_index],
+        sources.latitude[source_index],
+        facilities.longitude[facility_index],
+        facilities.latitude[facility_index],
+    )
+    flows = pd.DataFrame(
+        dict(
+            zip(
+                flow_labels,
+                (
+                    sources.marker_name[source_index],
+                    facilities.marker_name[facility_index],
+                    tons,
+                    distance,
+                    tons * distance,
+                ),
+            )
+        )
+    )
+    lines = [
+        (
+            (float(sources.longitude[i]), float(sources.latitude[i])),
+            (float(facilities.longitude[j]), float(facilities.latitude[j])),
+            float(amount),
+            f"{sources.marker_name[i]} -> {facilities.marker_name[j]}: "
+            f"{amount:.1f}, [т]",
+        )
+        for i, j, amount in zip(source_index, facility_index, tons)
+    ]
+    plan = TransportPlan(method, flows, lines)
+    _cache_put(_plans, _plans_lock, key, snapshot.version, plan, time_budget)
+    return plan
+
+
+def _cache_put(cache: OrderedDict, lock: threading.Lock, key, *value):
+    with lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > MAX_CACHED_RESULTS:
+            cache.popitem(last=False)
+
+
+def invalidate_logistics(db_name: str):
+    """
+    Сбрасывает кэшированные назначения площадок и планы перевозок базы
+    данных db_name
+    """
+    for cache, lock in (
+        (_assignments, _assignments_lock),
+        (_plans, _plans_lock),
+    ):
+        with lock:
+            for key in [key for key in cache if key[0] == db_name]:
+                del cache[key]
@@ -0,0 +1,67 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from map_layers import MapSettings
+from markers import MarkerSnapshot
+
+MAP_CACHE_MAX_BYTES = 64 * 1024**2  # предел памяти кэша карт, [байт]
+
+
+class MapHtmlCache:
+    """
+    Процессный LRU-кэш HTML-представлений карты с ограничением по памяти.
+    При превышении предела max_bytes вытесняются давно не использованные
+    карты
+    """
+
+    def __init__(self, max_bytes: int = MAP_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0  # [байт]
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            html = self._items.get(key)
+            if html is not None:
+                self._items.move_to_end(key)
+            return html
+
+    def put(self, key: str, html: str):
+        html_size = sys.getsizeof(html)
+        if html_size > self.max_bytes:
+            return  # карта не помещается в кэш целиком
+
+        with self._lock:
+            if key in self._items:
+                self.size -= sys.getsizeof(self._items.pop(key))
+            self._items[key] = html
+            self.size += html_size
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= sys.getsizeof(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+map_html_cache = MapHtmlCache()
+
+
+def map_cache_key(
+    snapshot: MarkerSnapshot, map_settings: MapSettings, tiles: str
+) -> str:
+    """
+    Возвращает ключ кэша карты: хэш содержимого снимка маркеров и
+    параметров карты (центр, масштаб, подложка, режим отображения)
+    """
+    params = repr((tuple(map_settings), tiles)).encode("utf-8")
+    return hashlib.sha1(snapshot.digest.encode("ascii") + params).hexdigest()
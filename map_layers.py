@@ -0,0 +1,292 @@
+import json
+import math
+from collections import namedtuple
+from typing import Iterable, List, Optional, Tuple
+
+from branca.element import CssLink, Element, JavascriptLink
+from folium import FeatureGroup, PolyLine
+from folium.map import Layer
+from jinja2 import Template
+
+from instrumentation import traced
+from markers import MarkerSnapshot, colors_for_marker
+
+MAP_WIDTH, MAP_HEIGHT = 1050, 550  # размер карты на странице, [px]
+
+# режимы отрисовки маркеров
+RENDER_MARKERS = "Отдельные маркеры"
+RENDER_CLUSTERS = "Кластеры маркеров"
+RENDER_MODES = (RENDER_MARKERS, RENDER_CLUSTERS)
+
+# ресурсы Leaflet.markercluster, как в folium.plugins.MarkerCluster
+_marker_cluster_cdn = (
+    "https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0"
+)
+
+MapSettings = namedtuple(
+    "MapSettings",
+    [
+        "longitude",
+        "latitude",
+        "zoom_start",
+        "render_mode",
+        "viewport_only",
+        "categories",  # категории маркеров, передаваемые на карту
+        # категории, слои которых включены при загрузке карты; маркеры
+        # остальных строятся в браузере при включении слоя
+        "visible_categories",
+        # категории источников и площадок и предел времени расчета
+        # потоков грузов или None, если потоки не выводятся
+        "transport",
+    ],
+)
+
+# границы области карты по колонкам таблицы маркеров
+Bounds = namedtuple(
+    "Bounds",
+    ["min_longitude", "max_longitude", "min_latitude", "max_latitude"],
+)
+
+
+def viewport_bounds(
+    longitude: float,
+    latitude: float,
+    zoom: int,
+    width: int = MAP_WIDTH,
+    height: int = MAP_HEIGHT,
+) -> Bounds:
+    """
+    Оценивает границы видимой области карты размером width x height
+    пикселей с центром в точке (longitude, latitude) при масштабе zoom.
+
+    Как и в map_creator, пара (longitude, latitude) передается в folium
+    в качестве location, т.е. первая координата откладывается по
+    вертикали карты, вторая -- по горизонтали
+    """
+    deg_per_px = 360 / (256 * 2**zoom)  # проекция Web Mercator
+    half_horizontal = width / 2 * deg_per_px
+    half_vertical = height / 2 * deg_per_px * math.cos(math.radians(longitude))
+    return Bounds(
+        min_longitude=longitude - half_vertical,
+        max_longitude=longitude + half_vertical,
+        min_latitude=latitude - half_horizontal,
+        max_latitude=latitude + half_horizontal,
+    )
+
+
+class _RawScript(Element):
+    """
+    Фрагмент сценария страницы, выводимый без обработки шаблонизатором
+    """
+
+    def __init__(self, code: str):
+        super().__init__()
+        self.code = code
+
+    def render(self, **kwargs) -> str:
+        return self.code
+
+
+def _script_json(data) -> str:
+    # символы <, > и & встречаются в JSON только внутри строк, поэтому их
+    # замена на escape-последовательности не меняет данных, но не дает
+    # закрыть тег <script> из имени маркера
+    return (
+        json.dumps(data, ensure_ascii=False)
+        .replace("<", "\\u003c")
+        .replace(">", "\\u003e")
+        .replace("&", "\\u0026")
+    )
+
+
+class ColumnarMarkerLayer(Layer):
+    """
+    Слой маркеров, данные которого передаются в браузер одним колоночным
+    массивом. Маркеры, иконки и всплывающие окна создаются на стороне
+    клиента; иконки строятся по одной на цвет, всплывающие окна -- при
+    первом открытии. Маркеры создаются при первом включении слоя, поэтому
+    скрытые слои (show=False) не тратят время браузера. При clustered=True
+    маркеры объединяются в кластеры
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function () {
+                var data = {{ this.get_name() }}_data;
+                var icons = data.colors.map(function (clr) {
+                    return L.AwesomeMarkers.icon({
+                        icon: "fa-cogs", prefix: "fa", markerColor: clr
+                    });
+                });
+                var escape = function (text) {
+                    var div = document.createElement("div");
+                    div.textContent = text;
+                    return div.innerHTML;
+                };
+                var popup = function (i) {
+                    return function () {
+                        return '<table rules="rows" col=2 width="255">'
+                            + '<tr><td><i>Имя маркера</i></td><td><i><b>'
+                            + escape(data.marker_name[i])
+                            + '</b></i></td></tr>'
+                            + '<tr><td><i>Категория</i></td><td>'
+                            + escape(data.categories[data.descr_code[i]])
+                            + '</td></tr>'
+                            + '<tr><td><i>Значение показателя</i></td><td>'
+                            + data.marker_value[i].toFixed(1)
+                            + ', [т]</td></tr></table>';
+                    };
+                };
+                {%- if this.clustered %}
+                var layer = L.markerClusterGroup({chunkedLoading: true});
+                {%- else %}
+                var layer = L.featureGroup();
+                {%- endif %}
+                // маркеры создаются при первом включении слоя
+                var loaded = false;
+                layer.on("add", function () {
+                    if (loaded) {
+                        return;
+                    }
+                    loaded = true;
+                    var markers = new Array(data.longitude.length);
+                    for (var i = 0; i < markers.length; i++) {
+                        markers[i] = L.marker(
+                            [data.longitude[i], data.latitude[i]],
+                            {icon: icons[data.clr_code[i]]}
+                        ).bindPopup(popup(i));
+                    }
+                    {%- if this.clustered %}
+                    layer.addLayers(markers);
+                    {%- else %}
+                    markers.forEach(function (marker) {
+                        layer.addLayer(marker);
+                    });
+                    {%- endif %}
+                });
+                return layer;
+            })();
+            {%- if this.show %}
+            {{ this._parent.get_name() }}.addLayer({{ this.get_name() }});
+            {%- endif %}
+        {% endmacro %}
+        """
+    )
+
+    def __init__(
+        self,
+        data: dict,
+        clustered: bool = False,
+        name: str = "Маркеры",
+        show: bool = True,
+    ):
+        super().__init__(name=name, overlay=True, show=show)
+        self._name = "ColumnarMarkerLayer"
+        self.data = data
+        self.clustered = clustered
+
+    def render(self, **kwargs):
+        figure = self.get_root()
+        # данные слоя добавляются в сценарий страницы готовой строкой:
+        # branca компилирует вывод шаблона как шаблон Jinja, что для
+        # массивов из десятков тысяч маркеров занимает большую часть
+        # времени построения карты
+        figure.script.add_child(
+            _RawScript(
+                f"var {self.get_name()}_data = {_script_json(self.data)};"
+            ),
+            name=f"{self.get_name()}_data",
+        )
+        super().render(**kwargs)
+        if not self.clustered:
+            return
+
+        figure.header.add_child(
+            JavascriptLink(f"{_marker_cluster_cdn}/leaflet.markercluster.js"),
+            name="markerclusterjs",
+        )
+        figure.header.add_child(
+            CssLink(f"{_marker_cluster_cdn}/MarkerCluster.css"),
+            name="markerclustercss",
+        )
+        figure.header.add_child(
+            CssLink(f"{_marker_cluster_cdn}/MarkerCluster.Default.css"),
+            name="markerclusterdefaultcss",
+        )
+
+
+def marker_layer(
+    snapshot: MarkerSnapshot,
+    clustered: bool = False,
+    name: str = "Маркеры",
+    show: bool = True,
+) -> ColumnarMarkerLayer:
+    """
+    Строит слой маркеров по колонкам снимка: категории и цвета передаются
+    кодами, без создания объектов folium на каждый маркер
+    """
+    data = {
+        "longitude": snapshot.longitude.tolist(),
+        "latitude": snapshot.latitude.tolist(),
+        "marker_name": snapshot.marker_name.tolist(),
+        "marker_value": snapshot.marker_value.tolist(),
+        "descr_code": snapshot.descr_code.tolist(),
+        "categories": snapshot.categories.tolist(),
+        "clr_code": snapshot.clr_code.tolist(),
+        "colors": [
+            colors_for_marker.get(clr, "gray") for clr in snapshot.colors
+        ],
+    }
+    return ColumnarMarkerLayer(data, clustered=clustered, name=name, show=show)
+
+
+@traced()
+def category_layers(
+    snapshot: MarkerSnapshot,
+    categories: Iterable[str],
+    clustered: bool = False,
+    visible_categories: Optional[Iterable[str]] = None,
+) -> List[ColumnarMarkerLayer]:
+    """
+    Строит по одному слою маркеров на каждую категорию из categories.
+    Маркеры остальных категорий не сериализуются и не передаются в браузер.
+
+    Слои категорий вне visible_categories (по умолчанию -- все категории)
+    выключены при загрузке карты: их маркеры создаются в браузере только
+    при включении слоя в панели слоев
+    """
+    categories = set(categories)
+    visible_categories = (
+        categories if visible_categories is None else set(visible_categories)
+    )
+    return [
+        marker_layer(
+            snapshot.take(snapshot.descr_code == code),
+            clustered=clustered,
+            name=category,
+            show=category in visible_categories,
+        )
+        for code, category in enumerate(snapshot.categories)
+        if category in categories
+    ]
+
+
+def flow_layer(
+    lines: List[Tuple[Tuple, Tuple, float, str]], name: str = "Потоки грузов"
+) -> FeatureGroup:
+    """
+    Строит слой линий потоков грузов (начало, конец, груз, подпись).
+    Толщина линии пропорциональна объему груза
+    """
+    layer = FeatureGroup(name=name)
+    max_amount = max((amount for _, _, amount, _ in lines), default=1.0)
+    for start, end, amount, label in lines:
+        PolyLine(
+            [start, end],
+            color="#3F72AF",
+            weight=2 + 6 * amount / max_amount,
+            opacity=0.7,
+            tooltip=label,
+        ).add_to(layer)
+    return layer
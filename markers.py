@@ -0,0 +1,357 @@
+import hashlib
+import threading
+from collections import namedtuple
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from database import (
+    db_change_version,
+    db_changes_since,
+    db_read_cursor,
+    db_read_table,
+    db_select_ids,
+)
+from instrumentation import traced
+
+Record = namedtuple(
+    "Record",
+    [
+        "id",
+        "longitude",
+        "latitude",
+        "marker_name",
+        "descr_pattern",
+        "marker_value",
+        "marker_clr",
+    ],
+)
+Record_wo_id = namedtuple(
+    "Record_wo_id",
+    [
+        "longitude",
+        "latitude",
+        "marker_name",
+        "descr_pattern",
+        "marker_value",
+        "marker_clr",
+    ],
+)
+
+
+def round_marker_value(marker_value: float) -> float:
+    """
+    Округляет значение показателя до десятых по десятичной записи числа
+    (0.35 -> 0.3, как при форматировании). Используется при добавлении
+    маркера из формы и при импорте, чтобы уникальный индекс сравнивал
+    одинаково округленные значения
+    """
+    return float(f"{marker_value:.1f}")
+
+
+# подписи колонок Record_wo_id для отображения в интерфейсе
+record_labels = [
+    "Долгота",
+    "Широта",
+    "Имя маркера",
+    "Категория",
+    "Значение показателя",
+    "Цвет маркера",
+]
+colors_for_marker = {
+    "красный": "red",
+    "темно-красный": "darkred",
+    "зеленый": "green",
+    "темно-зеленый": "darkgreen",
+    "синий": "blue",
+    "темно-синий": "darkblue",
+    "оранжевый": "orange",
+    "фиолетовый": "purple",
+    "черный": "black",
+}
+
+
+class MarkerSnapshot:
+    """
+    Неизменяемый колоночный снимок таблицы маркеров на момент версии
+    данных version. Координаты и значения показателя хранятся массивами
+    NumPy, категории и цвета -- целочисленными кодами с общими словарями
+    categories и colors. Один снимок обслуживает таблицу маркеров,
+    списки имен и слой карты; представления строятся без копирования
+    записей
+    """
+
+    def __init__(
+        self,
+        version: int,
+        ids: np.ndarray,
+        longitude: np.ndarray,
+        latitude: np.ndarray,
+        marker_name: np.ndarray,
+        descr_code: np.ndarray,
+        categories: np.ndarray,
+        marker_value: np.ndarray,
+        clr_code: np.ndarray,
+        colors: np.ndarray,
+    ):
+        self.version = version
+        self.ids = ids
+        self.longitude = longitude
+        self.latitude = latitude
+        self.marker_name = marker_name
+        self.descr_code = descr_code
+        self.categories = categories
+        self.marker_value = marker_value
+        self.clr_code = clr_code
+        self.colors = colors
+        self._digest = None
+
+    @classmethod
+    def from_records(
+        cls, version: int, records: List[Tuple]
+    ) -> "MarkerSnapshot":
+        """
+        Строит снимок из записей таблицы маркеров за один проход по
+        колонкам
+        """
+        if records:
+            ids, lon, lat, names, descr, value, clr = zip(*records)
+        else:
+            ids = lon = lat = names = descr = value = clr = ()
+        descr_code, categories = _factorize(descr)
+        clr_code, colors = _factorize(clr)
+        return cls(
+            version,
+            ids=np.array(ids, dtype=np.int64),
+            longitude=np.array(lon, dtype=np.float64),
+            latitude=np.array(lat, dtype=np.float64),
+            marker_name=np.array(names, dtype=object),
+            descr_code=descr_code,
+            categories=categories,
+            marker_value=np.array(value, dtype=np.float64),
+            clr_code=clr_code,
+            colors=colors,
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def digest(self) -> str:
+        """
+        Хэш содержимого снимка. Вычисляется один раз на снимок
+        """
+        if self._digest is None:
+            sha = hashlib.sha1()
+            for column in (
+                self.ids,
+                self.longitude,
+                self.latitude,
+                self.marker_value,
+                self.descr_code,
+                self.clr_code,
+            ):
+                sha.update(column.tobytes())
+            for labels in (self.marker_name, self.categories, self.colors):
+                sha.update("\0".join(labels).encode("utf-8"))
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    @property
+    def marker_names(self) -> List[str]:
+        return self.marker_name.tolist()
+
+    def descr_pattern(self) -> pd.Categorical:
+        return pd.Categorical.from_codes(self.descr_code, self.categories)
+
+    def marker_clr(self) -> pd.Categorical:
+        return pd.Categorical.from_codes(self.clr_code, self.colors)
+
+    def record(self, index: int) -> Record:
+        return Record(
+            int(self.ids[index]),
+            float(self.longitude[index]),
+            float(self.latitude[index]),
+            self.marker_name[index],
+            self.categories[self.descr_code[index]],
+            float(self.marker_value[index]),
+            self.colors[self.clr_code[index]],
+        )
+
+    def find(self, marker_name: str) -> Optional[Record]:
+        """
+        Возвращает маркер по имени или None
+        """
+        found = np.flatnonzero(self.marker_name == marker_name)
+        return self.record(found[0]) if len(found) else None
+
+    def take(self, mask: np.ndarray) -> "MarkerSnapshot":
+        """
+        Возвращает снимок из маркеров, отобранных маской или индексами
+        mask. Словари категорий и цветов остаются общими
+        """
+        return MarkerSnapshot(
+            self.version,
+            ids=self.ids[mask],
+            longitude=self.longitude[mask],
+            latitude=self.latitude[mask],
+            marker_name=self.marker_name[mask],
+            descr_code=self.descr_code[mask],
+            categories=self.categories,
+            marker_value=self.marker_value[mask],
+            clr_code=self.clr_code[mask],
+            colors=self.colors,
+        )
+
+    def within(
+        self,
+        min_longitude: float,
+        max_longitude: float,
+        min_latitude: float,
+        max_latitude: float,
+    ) -> "MarkerSnapshot":
+        """
+        Возвращает маркеры в прямоугольной области, заданной границами по
+        колонкам longitude и latitude
+        """
+        return self.take(
+            (self.longitude >= min_longitude)
+            & (self.longitude <= max_longitude)
+            & (self.latitude >= min_latitude)
+            & (self.latitude <= max_latitude)
+        )
+
+    def apply_changes(
+        self, version: int, changed_ids: Set[int], records: List[Tuple]
+    ) -> "MarkerSnapshot":
+        """
+        Возвращает снимок версии version: маркеры с id из changed_ids
+        заменяются текущими записями records, удаленные маркеры в records
+        отсутствуют. Порядок маркеров по id сохраняется
+        """
+        kept = self.take(
+            ~np.isin(self.ids, np.fromiter(changed_ids, dtype=np.int64))
+        )
+        added = MarkerSnapshot.from_records(version, records)
+        descr_code, categories = _merge_codes(
+            kept.descr_code,
+            kept.categories,
+            added.descr_code,
+            added.categories,
+        )
+        clr_code, colors = _merge_codes(
+            kept.clr_code, kept.colors, added.clr_code, added.colors
+        )
+        ids = np.concatenate([kept.ids, added.ids])
+        order = np.argsort(ids, kind="stable")
+        return MarkerSnapshot(
+            version,
+            ids=ids[order],
+            longitude=np.concatenate([kept.longitude, added.longitude])[order],
+            latitude=np.concatenate([kept.latitude, added.latitude])[order],
+            marker_name=np.concatenate([kept.marker_name, added.marker_name])[
+                order
+            ],
+            descr_code=descr_code[order],
+            categories=categories,
+            marker_value=np.concatenate(
+                [kept.marker_value, added.marker_value]
+            )[order],
+            clr_code=clr_code[order],
+            colors=colors,
+        )
+
+
+def _merge_codes(
+    codes1: np.ndarray,
+    labels1: np.ndarray,
+    codes2: np.ndarray,
+    labels2: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Объединяет две кодированные колонки в одну с общим словарем значений.
+    Значения, которые больше не встречаются, удаляются из словаря
+    """
+    labels = pd.Index(pd.unique(np.concatenate([labels1, labels2])))
+    codes = np.concatenate(
+        [
+            labels.get_indexer(labels1)[codes1],
+            labels.get_indexer(labels2)[codes2],
+        ]
+    )
+    used = np.unique(codes)
+    remap = np.zeros(len(labels), dtype=np.int32)
+    remap[used] = np.arange(len(used), dtype=np.int32)
+    return remap[codes], np.asarray(labels[used], dtype=object)
+
+
+def _factorize(values: Tuple[str, ...]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Кодирует значения целыми числами: возвращает коды и словарь значений
+    """
+    codes, labels = pd.factorize(np.array(values, dtype=object))
+    return codes.astype(np.int32), np.asarray(labels, dtype=object)
+
+
+# доля измененных маркеров, начиная с которой снимок перечитывается
+# целиком, а не обновляется по журналу изменений
+MAX_DELTA_SHARE = 0.25
+
+_snapshots = {}  # (путь к базе данных, таблица) -> снимок маркеров
+_snapshots_lock = threading.Lock()
+
+
+@traced()
+def get_marker_snapshot(db_name: str, tbl_name: str) -> MarkerSnapshot:
+    """
+    Возвращает снимок таблицы маркеров на последнюю версию журнала
+    изменений. Если данные менялись, к предыдущему снимку применяются
+    только изменения из журнала; таблица перечитывается целиком, лишь
+    когда журнал не покрывает разницу версий или изменений слишком много.
+    Изменения, сделанные другими процессами, также попадают в журнал
+    """
+    key = (db_name, tbl_name)
+    with db_read_cursor(db_name) as cur:
+        version = db_change_version(cur, tbl_name)
+    snapshot = _snapshots.get(key)
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+
+    with _snapshots_lock:
+        snapshot = _snapshots.get(key)
+        with db_read_cursor(db_name) as cur:
+            # версия журнала и записи читаются из одного состояния базы
+            cur.execute("BEGIN;")
+            version = db_change_version(cur, tbl_name)
+            if snapshot is not None and snapshot.version == version:
+                return snapshot
+
+            changes = None
+            if snapshot is not None:
+                changes = db_changes_since(cur, tbl_name, snapshot.version)
+            if changes is not None and len(changes) <= MAX_DELTA_SHARE * len(
+                snapshot
+            ):
+                changed_ids = {marker_id for _, marker_id, _ in changes}
+                snapshot = snapshot.apply_changes(
+                    version,
+                    changed_ids,
+                    db_select_ids(cur, tbl_name, changed_ids),
+                )
+            else:
+                snapshot = MarkerSnapshot.from_records(
+                    version, db_read_table(cur, tbl_name)
+                )
+        _snapshots[key] = snapshot
+    return snapshot
+
+
+def invalidate_marker_snapshot(db_name: str):
+    """
+    Принудительно делает снимки маркеров базы данных недействительными:
+    при следующем обращении таблица будет перечитана целиком
+    """
+    with _snapshots_lock:
+        for key in [key for key in _snapshots if key[0] == db_name]:
+            del _snapshots[key]
@@ -0,0 +1,249 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import pathlib2
+import shortuuid
+
+from database import db_aggregate, db_read_cursor
+from markers import record_labels
+
+REPORTS_DIR = "./reports"  # каталог готовых отчетов
+REPORT_EXCEL = "Excel (табличное представление)"
+REPORT_LATEX = "LaTeX (аналитика)"
+REPORT_FORMATS = (REPORT_EXCEL, REPORT_LATEX)
+REPORT_FETCH_SIZE = 5000  # число записей, читаемых из базы за раз
+MAX_REPORT_JOBS = 50  # сколько последних заданий хранится в реестре
+
+# статусы задания на подготовку отчета
+JOB_PENDING = "в очереди"
+JOB_RUNNING = "выполняется"
+JOB_DONE = "готов"
+JOB_FAILED = "ошибка"
+
+
+class ReportJob:
+    """
+    Задание на подготовку отчета, выполняемое в фоновом потоке
+    """
+
+    def __init__(self, job_id: str, report_format: str):
+        self.job_id = job_id
+        self.report_format = report_format
+        self.status = JOB_PENDING
+        self.progress = 0.0  # доля выполненной работы от 0 до 1
+        self.path = None  # путь к готовому отчету
+        self.error = None
+        self.created = time.time()
+
+    def set_progress(self, progress: float):
+        self.progress = min(max(progress, 0.0), 1.0)
+
+
+# один рабочий поток: отчеты не конкурируют с сессиями за базу данных
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="report")
+_jobs = OrderedDict()  # идентификатор задания -> задание
+_jobs_lock = threading.Lock()
+
+
+def submit_report(db_name: str, tbl_name: str, report_format: str) -> str:
+    """
+    Ставит в очередь задание на подготовку отчета и сразу возвращает
+    идентификатор задания
+    """
+    if report_format not in REPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат отчета: {report_format}")
+
+    job = ReportJob(shortuuid.uuid(), report_format)
+    with _jobs_lock:
+        _jobs[job.job_id] = job
+        while len(_jobs) > MAX_REPORT_JOBS:
+            _jobs.popitem(last=False)
+    _executor.submit(_run_report_job, job, db_name, tbl_name)
+    return job.job_id
+
+
+def get_report_job(job_id: str) -> Optional[ReportJob]:
+    return _jobs.get(job_id)
+
+
+def _run_report_job(job: ReportJob, db_name: str, tbl_name: str):
+    job.status = JOB_RUNNING
+    reports_dir = pathlib2.Path(REPORTS_DIR)
+    reports_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        if job.report_format == REPORT_EXCEL:
+            path = reports_dir / f"report_{job.job_id}.xlsx"
+            build_excel_report(db_name, tbl_name, path, job.set_progress)
+        else:
+            path = reports_dir / f"report_{job.job_id}.tex"
+            build_latex_report(db_name, tbl_name, path, job.set_progress)
+    except Exception as err:  # ошибка сохраняется в задании
+        job.error = str(err)
+        job.status = JOB_FAILED
+    else:
+        job.path = str(path)
+        job.progress = 1.0
+        job.status = JOB_DONE
+
+
+def build_excel_report(
+    db_name: str,
+    tbl_name: str,
+    path,
+    progress: Callable[[float], None] = lambda progress: None,
+):
+    """
+    Формирует табличный отчет: лист со всеми маркерами и листы сводок по
+    категориям и филиалам. Книга пишется в потоковом режиме, записи
+    читаются из базы порциями
+    """
+    import openpyxl  # загружается при первом табличном отчете
+
+    workbook = openpyxl.Workbook(write_only=True)
+    with db_read_cursor(db_name) as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {tbl_name};")
+        num_records = cur.fetchone()[0]
+
+        sheet = workbook.create_sheet("Маркеры")
+        sheet.append(record_labels)
+        cur.execute(
+            f"""
+            SELECT longitude, latitude, marker_name, descr_pattern,
+                   marker_value, marker_clr
+            FROM {tbl_name} ORDER BY id;
+            """
+        )
+        num_written = 0
+        while True:
+            rows = cur.fetchmany(REPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                sheet.append(row)
+            num_written += len(rows)
+            progress(0.9 * num_written / max(num_records, 1))
+
+        for title, by, label in (
+            ("По категориям", ("descr_pattern",), "Категория"),
+            ("По филиалам", ("region",), "Филиал"),
+        ):
+            sheet = workbook.create_sheet(title)
+            sheet.append([label, "Число маркеров", "Сумма, [т]"])
+            for row in db_aggregate(cur, tbl_name, by):
+                sheet.append(row)
+    workbook.save(str(path))
+
+
+_latex_special_chars = {
+    "\\": r"\textbackslash{}",
+    "&": r"\&",
+    "%": r"\%",
+    "$": r"\$",
+    "#": r"\#",
+    "_": r"\_",
+    "{": r"\{",
+    "}": r"\}",
+    "~": r"\textasciitilde{}",
+    "^": r"\textasciicircum{}",
+}
+
+
+def latex_escape(text) -> str:
+    return "".join(_latex_special_chars.get(char, char) for char in str(text))
+
+
+def _latex_table(label: str, rows: List[Tuple]) -> str:
+    lines = [
+        r"\begin{tabular}{lrr}",
+        r"\toprule",
+        f"{label} & Число маркеров & Сумма, [т] \\\\",
+        r"\midrule",
+    ]
+    lines += [
+        f"{latex_escape(key)} & {num_markers} & {total_value:.1f} \\\\"
+        for key, num_markers, total_value in rows
+    ]
+    lines += [r"\bottomrule", r"\end{tabular}"]
+    return "\n".join(lines)
+
+
+def _latex_bar_chart(title: str, rows: List[Tuple]) -> str:
+    # запятые разделяют символьные координаты pgfplots
+    labels = [latex_escape(key).replace(",", " ") for key, _, _ in rows]
+    coordinates = " ".join(
+        f"({label},{total_value:.1f})"
+        for label, (_, _, total_value) in zip(labels, rows)
+    )
+    return "\n".join(
+        [
+            r"\begin{tikzpicture}",
+            r"\begin{axis}[",
+            f"  title={{{title}}}, ybar, ymin=0,",
+            f"  symbolic x coords={{{','.join(labels)}}}, xtick=data,",
+            r"  x tick label style={rotate=45, anchor=east},",
+            r"  ylabel={Сумма, [т]}, width=\textwidth, height=7cm",
+            r"]",
+            f"\\addplot coordinates {{{coordinates}}};",
+            r"\end{axis}",
+            r"\end{tikzpicture}",
+        ]
+    )
+
+
+def build_latex_report(
+    db_name: str,
+    tbl_name: str,
+    path,
+    progress: Callable[[float], None] = lambda progress: None,
+):
+    """
+    Формирует аналитический отчет в формате LaTeX: сводные таблицы и
+    диаграммы (pgfplots) по категориям, филиалам и цветам маркеров.
+    Отчет строится по сводной таблице и не читает записи маркеров
+    """
+    sections = []
+    dimensions = (
+        ("Категории маркеров", ("descr_pattern",), "Категория"),
+        ("Филиалы", ("region",), "Филиал"),
+        ("Цвета маркеров", ("marker_clr",), "Цвет маркера"),
+    )
+    with db_read_cursor(db_name) as cur:
+        for num, (title, by, label) in enumerate(dimensions, start=1):
+            rows = db_aggregate(cur, tbl_name, by)
+            sections.append(
+                "\n".join(
+                    [
+                        f"\\section*{{{title}}}",
+                        r"\begin{center}",
+                        _latex_table(label, rows),
+                        r"\end{center}",
+                        r"\begin{center}",
+                        _latex_bar_chart(title, rows) if rows else "",
+                        r"\end{center}",
+                    ]
+                )
+            )
+            progress(num / len(dimensions))
+
+    document = "\n".join(
+        [
+            r"\documentclass[a4paper,11pt]{article}",
+            r"\usepackage[T2A]{fontenc}",
+            r"\usepackage[utf8]{inputenc}",
+            r"\usepackage[russian]{babel}",
+            r"\usepackage{booktabs}",
+            r"\usepackage{pgfplots}",
+            r"\pgfplotsset{compat=1.16}",
+            r"\begin{document}",
+            r"\title{Сводный отчет по базе данных маркеров}",
+            r"\date{\today}",
+            r"\maketitle",
+            *sections,
+            r"\end{document}",
+            "",
+        ]
+    )
+    pathlib2.Path(path).write_text(document, encoding="utf-8")
@@ -0,0 +1,6 @@
+import sys
+
+import pathlib2
+
+# модули приложения лежат в корне репозитория
+sys.path.insert(0, str(pathlib2.Path(__file__).resolve().parent.parent))
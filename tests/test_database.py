@@ -0,0 +1,270 @@
+import contextlib
+import io
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+from database import (
+    FIELD_REAL,
+    REGION_CENTERS,
+    _region_sql,
+    db_add_category_field,
+    db_category_fields,
+    db_count_markers,
+    db_create_table,
+    db_dump_sql,
+    db_ensure_table,
+    db_get_attributes,
+    db_insert_record_many,
+    db_read_cursor,
+    db_read_table,
+    db_select_nearest,
+    db_select_radius,
+    db_set_attributes,
+    db_write_cursor,
+    get_connection_manager,
+    haversine_km,
+)
+
+TBL_NAME = "markers"
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    db_name = str(tmp_path / "markers.sqlite")
+    with db_write_cursor(db_name) as cur:
+        db_create_table(cur, TBL_NAME)
+    yield db_name
+    get_connection_manager(db_name).close()
+
+
+def _fill(db_name, longitudes, latitudes):
+    with db_write_cursor(db_name) as cur:
+        db_insert_record_many(
+            cur,
+            TBL_NAME,
+            [
+                (float(lon), float(lat), f"M_{num}", "Лом", 1.0, "красный")
+                for num, (lon, lat) in enumerate(zip(longitudes, latitudes))
+            ],
+        )
+
+
+def _brute_force(cur, longitude, latitude, radius_km):
+    return sorted(
+        record[0]
+        for record in db_read_table(cur, TBL_NAME)
+        if haversine_km(longitude, latitude, record[1], record[2]) <= radius_km
+    )
+
+
+@pytest.mark.parametrize("radius_km", [100.0, 1000.0, 1500.0, 2500.0])
+def test_select_radius_matches_brute_force(db_name, radius_km):
+    rng = np.random.RandomState(0)
+    _fill(db_name, rng.uniform(40.0, 89.0, 20000), rng.uniform(0, 150, 20000))
+    with db_read_cursor(db_name) as cur:
+        found = db_select_radius(cur, TBL_NAME, 66.0, 72.0, radius_km)
+        expected = _brute_force(cur, 66.0, 72.0, radius_km)
+    assert sorted(record[0] for record, _ in found) == expected
+
+
+@pytest.mark.parametrize(
+    "longitude, latitude, radius_km",
+    [
+        (85.0, 10.0, 800.0),  # шапка содержит северный полюс
+        (-88.0, -120.0, 500.0),  # шапка содержит южный полюс
+        (60.0, 178.0, 700.0),  # шапка пересекает антимеридиан
+        (-30.0, -179.0, 1200.0),
+        (0.0, 0.0, 15000.0),  # больше четверти окружности
+        (10.0, 20.0, 3.2e4),  # весь земной шар
+    ],
+)
+def test_select_radius_poles_and_antimeridian(
+    db_name, longitude, latitude, radius_km
+):
+    rng = np.random.RandomState(1)
+    _fill(
+        db_name, rng.uniform(-90.0, 90.0, 5000), rng.uniform(-180, 180, 5000)
+    )
+    with db_read_cursor(db_name) as cur:
+        found = db_select_radius(cur, TBL_NAME, longitude, latitude, radius_km)
+        expected = _brute_force(cur, longitude, latitude, radius_km)
+    assert sorted(record[0] for record, _ in found) == expected
+
+
+def test_select_nearest_matches_brute_force(db_name):
+    rng = np.random.RandomState(2)
+    _fill(db_name, rng.uniform(60.0, 89.0, 300), rng.uniform(-180, 180, 300))
+    with db_read_cursor(db_name) as cur:
+        found = db_select_nearest(cur, TBL_NAME, 88.0, 0.0, 5)
+        records = db_read_table(cur, TBL_NAME)
+    distances = sorted(
+        haversine_km(88.0, 0.0, record[1], record[2]) for record in records
+    )
+    assert [distance for _, distance in found] == pytest.approx(distances[:5])
+
+
+def test_exhausted_read_pool_raises_database_error(tmp_path):
+    manager = get_connection_manager(str(tmp_path / "pool.sqlite"))
+    manager.busy_timeout = 50
+    with contextlib.ExitStack() as stack:
+        for _ in range(manager.pool_size):
+            stack.enter_context(manager.read_cursor())
+        with pytest.raises(sqlite3.OperationalError):
+            with manager.read_cursor():
+                pass
+    with manager.read_cursor() as cur:  # соединения вернулись в пул
+        cur.execute("SELECT 1;")
+    manager.close()
+
+
+def test_sql_dump_restores_attributes(db_name, tmp_path):
+    _fill(db_name, [55.0, 56.0], [37.0, 38.0])
+    with db_write_cursor(db_name) as cur:
+        db_add_category_field(
+            cur, TBL_NAME, "Лом", "mass", FIELD_REAL, "Масса"
+        )
+        db_set_attributes(cur, TBL_NAME, 1, dict(mass=12.5))
+    dump = io.StringIO()
+    with db_read_cursor(db_name) as cur:
+        db_dump_sql(cur, TBL_NAME, dump)
+
+    restored_name = str(tmp_path / "restored.sqlite")
+    conn = sqlite3.connect(restored_name)
+    conn.executescript(dump.getvalue())
+    conn.close()
+    with db_write_cursor(restored_name) as cur:
+        db_create_table(cur, TBL_NAME)
+    with db_read_cursor(restored_name) as cur:
+        assert len(db_read_table(cur, TBL_NAME)) == 2
+        assert db_category_fields(cur, TBL_NAME) == [
+            ("Лом", "mass", FIELD_REAL, "Масса")
+        ]
+        assert db_get_attributes(cur, TBL_NAME, 1) == dict(mass=12.5)
+    get_connection_manager(restored_name).close()
+
+
+def _has_table(db_name, name):
+    with db_read_cursor(db_name) as cur:
+        cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;",
+            (name,),
+        )
+        return cur.fetchone() is not None
+
+
+def test_ensure_table_rebuilds_replaced_or_deleted_file(tmp_path):
+    db_name = str(tmp_path / "app.sqlite")
+    db_ensure_table(db_name, TBL_NAME)
+    _fill(db_name, [55.0], [37.0])
+    dump = io.StringIO()
+    with db_read_cursor(db_name) as cur:
+        db_dump_sql(cur, TBL_NAME, dump)
+
+    # восстановление из SQL-дампа в новый файл, подменяющий базу данных
+    restored_name = str(tmp_path / "restored.sqlite")
+    conn = sqlite3.connect(restored_name)
+    conn.executescript(dump.getvalue())
+    conn.close()
+    os.replace(restored_name, db_name)
+    db_ensure_table(db_name, TBL_NAME)
+    assert _has_table(db_name, f"{TBL_NAME}_stats")
+    with db_read_cursor(db_name) as cur:
+        assert db_count_markers(cur, TBL_NAME) == 1
+
+    # служебная таблица удалена в том же файле
+    conn = sqlite3.connect(db_name)
+    conn.execute(f"DROP TABLE {TBL_NAME}_stats;")
+    conn.close()
+    db_ensure_table(db_name, TBL_NAME)
+    assert _has_table(db_name, f"{TBL_NAME}_stats")
+
+    os.remove(db_name)  # файл удален при открытых соединениях
+    db_ensure_table(db_name, TBL_NAME)
+    assert _has_table(db_name, TBL_NAME)
+    get_connection_manager(db_name).close()
+
+
+def test_checked_out_connection_is_not_reused_after_close(tmp_path):
+    db_name = str(tmp_path / "app.sqlite")
+    db_ensure_table(db_name, TBL_NAME)
+    _fill(db_name, [55.0, 56.0], [37.0, 38.0])
+    manager = get_connection_manager(db_name)
+    with db_read_cursor(db_name) as cur:
+        cur.execute("SELECT 1;")
+        os.remove(db_name)
+        assert db_ensure_table(db_name, TBL_NAME)
+    with db_read_cursor(db_name) as cur:
+        assert db_read_table(cur, TBL_NAME) == []
+    assert manager._num_read_conns <= manager.pool_size
+    manager.close()
+
+
+def test_ensure_table_reports_replaced_file(tmp_path):
+    db_name = str(tmp_path / "app.sqlite")
+    assert not db_ensure_table(db_name, TBL_NAME)
+    assert not db_ensure_table(db_name, TBL_NAME)
+    get_connection_manager(db_name).close()
+    os.remove(db_name)
+    assert db_ensure_table(db_name, TBL_NAME)
+    get_connection_manager(db_name).close()
+
+
+def _stats_and_recount(db_name):
+    with db_read_cursor(db_name) as cur:
+        cur.execute(
+            f"""
+            SELECT region, descr_pattern, marker_clr, num_markers,
+                   round(total_value, 6)
+            FROM {TBL_NAME}_stats ORDER BY 1, 2, 3;
+            """
+        )
+        stats = cur.fetchall()
+        cur.execute(
+            f"""
+            SELECT region, descr_pattern, marker_clr, COUNT(*),
+                   round(SUM(marker_value), 6)
+            FROM (
+              SELECT {_region_sql(TBL_NAME, "m")} AS region,
+                     descr_pattern, marker_clr, marker_value
+              FROM {TBL_NAME} AS m
+            )
+            GROUP BY 1, 2, 3 ORDER BY 1, 2, 3;
+            """
+        )
+        return stats, cur.fetchall()
+
+
+@pytest.mark.parametrize("sqlite_version", [(3, 23, 1), (3, 40, 0)])
+def test_stats_triggers_match_recount(tmp_path, monkeypatch, sqlite_version):
+    monkeypatch.setattr(sqlite3, "sqlite_version_info", sqlite_version)
+    db_name = str(tmp_path / "stats.sqlite")
+    with db_write_cursor(db_name) as cur:
+        db_create_table(cur, TBL_NAME)
+    rng = np.random.RandomState(3)
+    _fill(db_name, rng.uniform(44.0, 66.0, 500), rng.uniform(35, 85, 500))
+    with db_write_cursor(db_name) as cur:
+        cur.execute(f"DELETE FROM {TBL_NAME} WHERE id % 3 = 0;")
+        cur.execute(
+            f"""
+            UPDATE {TBL_NAME}
+            SET marker_value = marker_value + 2, longitude = longitude + 5,
+                marker_clr = 'синий'
+            WHERE id % 5 = 0;
+            """
+        )
+    stats, recount = _stats_and_recount(db_name)
+    assert stats == recount
+    get_connection_manager(db_name).close()
+
+
+def test_changed_region_list_rebuilds_stats(db_name, monkeypatch):
+    _fill(db_name, [55.7, 66.0], [37.6, 76.5])
+    monkeypatch.setitem(REGION_CENTERS, "Новый Уренгой", (66.08, 76.68))
+    with db_write_cursor(db_name) as cur:
+        db_create_table(cur, TBL_NAME)
+    stats, recount = _stats_and_recount(db_name)
+    assert stats == recount
+    assert "Новый Уренгой" in {row[0] for row in stats}
@@ -0,0 +1,65 @@
+import openpyxl
+import pandas as pd
+
+from importer import iter_markers_chunks, prepare_markers
+from markers import round_marker_value
+
+
+def test_import_rounds_values_like_the_form():
+    values = [0.35, 0.05, 1.15, 2.25, 6530.324]
+    df = pd.DataFrame(
+        dict(
+            longitude=[55.0] * len(values),
+            latitude=[37.0] * len(values),
+            marker_name=[f"m_{num}" for num in range(len(values))],
+            descr_pattern=["Лом"] * len(values),
+            marker_value=values,
+            marker_clr=["красный"] * len(values),
+        )
+    )
+    prepared, rejects = prepare_markers(df)
+    assert not rejects
+    assert prepared["marker_value"].tolist() == [
+        round_marker_value(value) for value in values
+    ]
+
+
+HEADER = [
+    "Широта",
+    "Долгота",
+    "Маркер",
+    "Категория",
+    "Показатель",
+    "Цвет",
+]
+GOOD_ROW = [55.0, 37.0, "m", "Лом", 1.0, "красный"]
+BAD_ROW = [55.0, "нет", "m", "Лом", 1.0, "красный"]
+
+
+def _rejected_rows(file_name, chunk_size):
+    rows = []
+    for chunk, _ in iter_markers_chunks(file_name, chunk_size):
+        rows.extend(row for row, _ in prepare_markers(chunk)[1])
+    return rows
+
+
+def test_rejects_are_reported_by_csv_file_row(tmp_path):
+    file_name = tmp_path / "markers.csv"
+    rows = [HEADER, GOOD_ROW, GOOD_ROW, BAD_ROW, GOOD_ROW, BAD_ROW]
+    file_name.write_text(
+        "\n".join(",".join(map(str, row)) for row in rows), encoding="utf-8"
+    )
+    # строка 1 -- заголовок, порции не сбивают нумерацию
+    assert _rejected_rows(str(file_name), chunk_size=2) == [4, 6]
+
+
+def test_rejects_are_reported_by_xlsx_sheet_row(tmp_path):
+    file_name = tmp_path / "markers.xlsx"
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in [HEADER, GOOD_ROW, [None] * 6, BAD_ROW, [None] * 6]:
+        sheet.append(row)
+    sheet.append(BAD_ROW)
+    workbook.save(file_name)
+    # пустые строки 3 и 5 пропускаются, но не сдвигают номера
+    assert _rejected_rows(str(file_name), chunk_size=1) == [4, 6]
@@ -0,0 +1,66 @@
+import pytest
+
+import logistics
+from database import (
+    db_create_table,
+    db_insert_record_many,
+    db_write_cursor,
+    get_connection_manager,
+)
+
+TBL_NAME = "markers"
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    db_name = str(tmp_path / "markers.sqlite")
+    with db_write_cursor(db_name) as cur:
+        db_create_table(cur, TBL_NAME)
+        db_insert_record_many(
+            cur,
+            TBL_NAME,
+            [
+                (55.0, 37.0, "ЛОМ_1", "Лом", 10.0, "красный"),
+                (56.0, 38.0, "ЛОМ_2", "Лом", 5.0, "красный"),
+                (55.5, 37.5, "ПЛОЩАДКА", "Площадки по отходам", 50.0, "синий"),
+            ],
+        )
+    yield db_name
+    logistics.invalidate_logistics(db_name)
+    get_connection_manager(db_name).close()
+
+
+def test_greedy_plan_is_recomputed_with_larger_budget(db_name, monkeypatch):
+    methods = iter([logistics.METHOD_GREEDY, logistics.METHOD_LP])
+    calls = []
+
+    def solve_transport(sources, facilities, time_budget):
+        calls.append(time_budget)
+        return (next(methods), [0, 1], [0, 0], [10.0, 5.0])
+
+    monkeypatch.setattr(logistics, "solve_transport", solve_transport)
+    plan = logistics.get_transport_plan(db_name, TBL_NAME, time_budget=1.0)
+    assert plan.method == logistics.METHOD_GREEDY
+    logistics.get_transport_plan(db_name, TBL_NAME, time_budget=1.0)
+    plan = logistics.get_transport_plan(db_name, TBL_NAME, time_budget=60.0)
+    assert plan.method == logistics.METHOD_LP
+    logistics.get_transport_plan(db_name, TBL_NAME, time_budget=5.0)
+    assert calls == [1.0, 60.0]
+
+
+def test_cached_plans_are_bounded(db_name, monkeypatch):
+    monkeypatch.setattr(
+        logistics,
+        "solve_transport",
+        lambda sources, facilities, time_budget: (
+            logistics.METHOD_LP,
+            [],
+            [],
+            [],
+        ),
+    )
+    for num in range(logistics.MAX_CACHED_RESULTS + 5):
+        logistics.get_transport_plan(
+            db_name, TBL_NAME, ("Лом", f"категория {num}")
+        )
+    assert len(logistics._plans) == logistics.MAX_CACHED_RESULTS
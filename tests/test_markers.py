@@ -0,0 +1,153 @@
+import pytest
+
+import database
+import markers
+from database import (
+    db_change_version,
+    db_changes_since,
+    db_create_table,
+    db_delete_records,
+    db_insert_record_many,
+    db_read_cursor,
+    db_read_table,
+    db_reset_table,
+    db_write_cursor,
+    get_connection_manager,
+)
+from markers import (
+    MarkerSnapshot,
+    get_marker_snapshot,
+    invalidate_marker_snapshot,
+)
+
+TBL_NAME = "markers"
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    db_name = str(tmp_path / "markers.sqlite")
+    with db_write_cursor(db_name) as cur:
+        db_create_table(cur, TBL_NAME)
+    yield db_name
+    invalidate_marker_snapshot(db_name)
+    get_connection_manager(db_name).close()
+
+
+@pytest.fixture
+def full_reads(monkeypatch):
+    """
+    Считает, сколько раз снимок перечитывал таблицу целиком
+    """
+    calls = []
+
+    def db_read_table_spy(cur, tbl_name):
+        calls.append(tbl_name)
+        return db_read_table(cur, tbl_name)
+
+    monkeypatch.setattr(markers, "db_read_table", db_read_table_spy)
+    return calls
+
+
+def _fill(db_name, num_markers, descr_pattern="Лом", marker_clr="красный"):
+    with db_write_cursor(db_name) as cur:
+        db_insert_record_many(
+            cur,
+            TBL_NAME,
+            [
+                (
+                    50.0 + num / 100,
+                    40.0,
+                    f"{descr_pattern.upper()}_{num}",
+                    descr_pattern,
+                    float(num),
+                    marker_clr,
+                )
+                for num in range(num_markers)
+            ],
+        )
+
+
+def _update(db_name, marker_name, **values):
+    columns = ", ".join(f"{column} = ?" for column in values)
+    with db_write_cursor(db_name) as cur:
+        cur.execute(
+            f"UPDATE {TBL_NAME} SET {columns} WHERE marker_name = ?;",
+            [*values.values(), marker_name],
+        )
+
+
+def _assert_matches_table(db_name, snapshot):
+    with db_read_cursor(db_name) as cur:
+        version = db_change_version(cur, TBL_NAME)
+        expected = MarkerSnapshot.from_records(
+            version, db_read_table(cur, TBL_NAME)
+        )
+    assert snapshot.version == version
+    assert [snapshot.record(num) for num in range(len(snapshot))] == [
+        expected.record(num) for num in range(len(expected))
+    ]
+    # в словарях остаются только используемые значения
+    assert sorted(snapshot.categories) == sorted(expected.categories)
+    assert sorted(snapshot.colors) == sorted(expected.colors)
+
+
+def test_incremental_snapshot_matches_full_read(db_name, full_reads):
+    _fill(db_name, 40)
+    _fill(db_name, 2, descr_pattern="Пластик", marker_clr="синий")
+    _assert_matches_table(db_name, get_marker_snapshot(db_name, TBL_NAME))
+
+    # новые категория и цвет добавляются к словарям снимка
+    _fill(db_name, 3, descr_pattern="Стекло", marker_clr="зеленый")
+    _assert_matches_table(db_name, get_marker_snapshot(db_name, TBL_NAME))
+
+    _update(db_name, "ЛОМ_1", marker_value=100.0, longitude=60.0)
+    _update(db_name, "ПЛАСТИК_0", descr_pattern="Лом", marker_clr="красный")
+    _assert_matches_table(db_name, get_marker_snapshot(db_name, TBL_NAME))
+
+    with db_write_cursor(db_name) as cur:
+        db_delete_records(cur, TBL_NAME, marker_names=["ПЛАСТИК_1", "ЛОМ_5"])
+    snapshot = get_marker_snapshot(db_name, TBL_NAME)
+    _assert_matches_table(db_name, snapshot)
+    assert "Пластик" not in snapshot.categories
+    assert "синий" not in snapshot.colors
+
+    assert len(full_reads) == 1
+
+
+def test_snapshot_is_reread_after_reset(db_name, full_reads):
+    _fill(db_name, 40)
+    get_marker_snapshot(db_name, TBL_NAME)
+
+    with db_write_cursor(db_name) as cur:
+        db_reset_table(cur, TBL_NAME)
+    # id новой таблицы начинаются заново и совпадают с id старых маркеров
+    _fill(db_name, 2, descr_pattern="Стекло", marker_clr="зеленый")
+    snapshot = get_marker_snapshot(db_name, TBL_NAME)
+    _assert_matches_table(db_name, snapshot)
+    assert snapshot.ids.tolist() == [1, 2]
+    assert snapshot.marker_names == ["СТЕКЛО_0", "СТЕКЛО_1"]
+
+    assert len(full_reads) == 2
+
+
+def test_snapshot_is_reread_when_log_is_trimmed(
+    tmp_path, monkeypatch, full_reads
+):
+    monkeypatch.setattr(database, "CHANGE_LOG_SIZE", 10)
+    db_name = str(tmp_path / "markers.sqlite")
+    try:
+        with db_write_cursor(db_name) as cur:
+            db_create_table(cur, TBL_NAME)
+        _fill(db_name, 100)
+        version = get_marker_snapshot(db_name, TBL_NAME).version
+
+        for num in range(12):
+            _update(db_name, f"ЛОМ_{num}", marker_value=-1.0)
+        with db_read_cursor(db_name) as cur:
+            assert db_changes_since(cur, TBL_NAME, version) is None
+        _assert_matches_table(db_name, get_marker_snapshot(db_name, TBL_NAME))
+
+        assert len(full_reads) == 2
+    finally:
+        invalidate_marker_snapshot(db_name)
+        get_connection_manager(db_name).close()